@@ -1,13 +1,21 @@
+import argparse
 import json
-import random
+import os
+import queue
+import threading
 import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 
 import requests
 from openpyxl import Workbook, load_workbook
 
 import config
+import metrics
+from rate_limit import TokenBucket, retry_after_seconds
+
+AMO_LIMITER = TokenBucket(config.AMO_RATE_LIMIT)
 
 
 def log(message: str) -> None:
@@ -18,10 +26,12 @@ def log(message: str) -> None:
 
 
 class AmoClient:
-    def __init__(self, base_url: str, tokens_file: str):
+    def __init__(self, base_url: str, tokens_file: str, limiter: Optional[TokenBucket] = None):
         self.base_url = base_url.rstrip("/")
         self.tokens_file = tokens_file
         self.tokens = self._load_tokens()
+        self.limiter = limiter or AMO_LIMITER
+        self._refresh_lock = threading.Lock()
 
     def _load_tokens(self) -> Dict[str, str]:
         try:
@@ -70,30 +80,42 @@ class AmoClient:
 
     def request(self, method: str, path: str, params=None, retry=0):
         url = f"{self.base_url}{path}"
+        access_token = self.tokens.get("access_token", "")
         headers = {
-            "Authorization": f"Bearer {self.tokens.get('access_token', '')}",
+            "Authorization": f"Bearer {access_token}",
             "Accept": "application/hal+json",
         }
         try:
             log(f"{method} {url} params={params} attempt={retry + 1}")
-            resp = requests.request(method, url, headers=headers, params=params, timeout=30)
+            self.limiter.acquire()
+            resp = metrics.observe(
+                "amocrm", path,
+                lambda: requests.request(method, url, headers=headers, params=params, timeout=30)
+            )
             log(f"{method} {url} -> {resp.status_code}")
         except requests.RequestException:
             if retry >= 3:
                 raise
+            metrics.record_retry("amocrm", path)
             time.sleep(1 + retry)
             return self.request(method, path, params=params, retry=retry + 1)
 
         if resp.status_code == 401:
             if retry >= 1:
                 resp.raise_for_status()
-            self._refresh_tokens()
+            with self._refresh_lock:
+                # Параллельные потоки обновляют токен один раз: refresh_token одноразовый
+                if self.tokens.get("access_token", "") == access_token:
+                    self._refresh_tokens()
             return self.request(method, path, params=params, retry=retry + 1)
 
         if resp.status_code == 429:
             if retry >= 5:
                 resp.raise_for_status()
-            time.sleep(random.uniform(1, 3))
+            delay = retry_after_seconds(resp, default=1 + retry)
+            log(f"{method} {url} rate limited, retry after {delay:.1f}s")
+            metrics.record_retry("amocrm", path)
+            self.limiter.penalize(delay)
             return self.request(method, path, params=params, retry=retry + 1)
 
         resp.raise_for_status()
@@ -148,13 +170,83 @@ def is_ck_lead(lead) -> bool:
     return False
 
 
-def iter_leads(client: AmoClient):
+def load_ck_state() -> Dict:
+    try:
+        with open(config.CK_STATE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {"last_run": None, "leads": {}}
+    return {
+        "last_run": data.get("last_run"),
+        "leads": {str(k): str(v) for k, v in (data.get("leads") or {}).items()},
+    }
+
+
+def save_ck_state(state: Dict) -> None:
+    tmp_path = f"{config.CK_STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, config.CK_STATE_FILE)
+
+
+def apply_lead(state_leads: Dict[str, str], counts: Counter, lead) -> bool:
+    lead_id = str(lead.get("id") or "")
+    if not lead_id:
+        return False
+    previous = state_leads.get(lead_id)
+    current = None
+    # Удалённая сделка выпадает из состояния так же, как сделка, переставшая быть ЦК
+    if not lead.get("is_deleted") and is_ck_lead(lead):
+        current = str(lead.get("responsible_user_id") or "")
+    if previous == current:
+        return current is not None
+    if previous is not None:
+        state_leads.pop(lead_id, None)
+        if previous:
+            counts[previous] -= 1
+    if current is not None:
+        state_leads[lead_id] = current
+        if current:
+            counts[current] += 1
+    return current is not None
+
+
+def fetch_deleted_lead_ids(client: AmoClient, created_from: int) -> set:
+    """id сделок, удалённых начиная с created_from: инкрементальный скан по updated_at их не возвращает."""
+    deleted = set()
+    page = 1
+    while True:
+        params = {
+            "limit": 100,
+            "page": page,
+            "filter[type]": "lead_deleted",
+            "filter[created_at][from]": created_from,
+        }
+        resp = client.request("GET", "/api/v4/events", params=params)
+        if resp.status_code == 204:
+            break
+        events = resp.json().get("_embedded", {}).get("events", []) or []
+        if not events:
+            break
+        for event in events:
+            if event.get("entity_id"):
+                deleted.add(str(event["entity_id"]))
+        page += 1
+    return deleted
+
+
+def ck_filter_params() -> Dict[str, int]:
+    return {f"filter[custom_fields_values][{config.CK_FIELD_ID}][]": config.CK_ENUM_ID}
+
+
+def iter_leads(client: AmoClient, updated_from: Optional[int] = None, extra_params: Optional[Dict] = None):
     page = 1
     processed = 0
     while True:
-        resp = client.request("GET", "/api/v4/leads", params={"limit": 250, "page": page})
-        data = resp.json()
-        leads = data.get("_embedded", {}).get("leads", [])
+        params = {"limit": 250, "page": page, **(extra_params or {})}
+        if updated_from:
+            params["filter[updated_at][from]"] = updated_from
+        leads = fetch_leads_page(client, params)
         log(f"Leads page {page}: {len(leads)}")
         if not leads:
             break
@@ -165,6 +257,98 @@ def iter_leads(client: AmoClient):
     return processed
 
 
+def fetch_leads_page(client: AmoClient, params) -> list:
+    resp = client.request("GET", "/api/v4/leads", params=params)
+    if resp.status_code == 204:
+        return []
+    return resp.json().get("_embedded", {}).get("leads", []) or []
+
+
+def lead_created_bounds(client: AmoClient, extra_params: Optional[Dict] = None):
+    first = fetch_leads_page(client, {"limit": 1, "order[created_at]": "asc", **(extra_params or {})})
+    if not first:
+        return None, None
+    start = int(first[0].get("created_at") or 0)
+    return start, int(time.time())
+
+
+def split_range(start: int, end: int, shards: int):
+    shards = max(1, shards)
+    step = max(1, (end - start + shards) // shards)
+    windows = []
+    lo = start
+    while lo <= end:
+        hi = min(end, lo + step - 1)
+        windows.append((lo, hi))
+        lo = hi + 1
+    return windows
+
+
+def iter_leads_sharded(client: AmoClient, shards: int, workers: int, lead_filter=None,
+                       scan_stats: Optional[Counter] = None, extra_params: Optional[Dict] = None):
+    start, end = lead_created_bounds(client, extra_params=extra_params)
+    if start is None:
+        return
+    windows = split_range(start, end, shards)
+    log(f"Sharded scan: {len(windows)} shards, {workers} workers, created_at {start}..{end}")
+    results = queue.Queue(maxsize=workers * 500)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def scan(window):
+        lo, hi = window
+        page = 1
+        try:
+            while not stop.is_set():
+                params = {
+                    "limit": 250,
+                    "page": page,
+                    "filter[created_at][from]": lo,
+                    "filter[created_at][to]": hi,
+                    **(extra_params or {}),
+                }
+                leads = fetch_leads_page(client, params)
+                log(f"Shard {lo}..{hi} page {page}: {len(leads)}")
+                if scan_stats is not None:
+                    scan_stats["pages"] += 1
+                    scan_stats["leads"] += len(leads)
+                for lead in leads:
+                    if lead_filter is None or lead_filter(lead):
+                        put(lead)
+                if len(leads) < 250:
+                    break
+                page += 1
+        except Exception as exc:
+            put(exc)
+        finally:
+            put(done)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        for window in windows:
+            pool.submit(scan, window)
+        remaining = len(windows)
+        while remaining:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 def ensure_headers(sheet, headers):
     header_row = 1
     current = {cell.value: idx + 1 for idx, cell in enumerate(sheet[header_row]) if cell.value}
@@ -176,7 +360,61 @@ def ensure_headers(sheet, headers):
     return current
 
 
-def write_counts_to_excel(users_map, counts_responsible):
+def excel_signature(path: str) -> Optional[Dict[str, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def load_excel_index() -> Optional[Dict]:
+    try:
+        with open(config.EXCEL_INDEX_FILE, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if index.get("sheet") != config.EXCEL_SHEET:
+        return None
+    if index.get("signature") != excel_signature(config.EXCEL_PATH):
+        # Файл правили вручную или он пропал: индексу больше нельзя верить
+        return None
+    return index
+
+
+def save_excel_index(columns: Dict[str, int], rows_by_id: Dict[str, int], values: Dict, max_row: int) -> None:
+    index = {
+        "sheet": config.EXCEL_SHEET,
+        "signature": excel_signature(config.EXCEL_PATH),
+        "columns": columns,
+        "rows": rows_by_id,
+        "values": values,
+        "max_row": max_row,
+    }
+    tmp_path = f"{config.EXCEL_INDEX_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, config.EXCEL_INDEX_FILE)
+
+
+def count_sheet_rows(path: str) -> int:
+    try:
+        wb = load_workbook(path, read_only=True)
+    except FileNotFoundError:
+        return 0
+    try:
+        if config.EXCEL_SHEET not in wb.sheetnames:
+            return 0
+        ws = wb[config.EXCEL_SHEET]
+        if ws.max_row:
+            return ws.max_row
+        # Файлы из write-only режима не хранят размерность листа
+        return sum(1 for _ in ws.iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+
+def write_rows_inplace(desired, changed, index):
     try:
         wb = load_workbook(config.EXCEL_PATH)
     except FileNotFoundError:
@@ -195,28 +433,122 @@ def write_counts_to_excel(users_map, counts_responsible):
     ]
     header_map = ensure_headers(sheet, headers)
 
-    all_ids = set(counts_responsible)
-    rows_by_id = {}
-    for row in range(2, sheet.max_row + 1):
-        cell_value = sheet.cell(row=row, column=header_map[config.EMPLOYEE_ID_COLUMN]).value
-        if cell_value is not None:
-            rows_by_id[str(cell_value)] = row
+    if index and index.get("columns") == header_map:
+        rows_by_id = dict(index["rows"])
+    else:
+        rows_by_id = {}
+        for row in range(2, sheet.max_row + 1):
+            cell_value = sheet.cell(row=row, column=header_map[config.EMPLOYEE_ID_COLUMN]).value
+            if cell_value is not None:
+                rows_by_id[str(cell_value)] = row
 
     current_row = sheet.max_row + 1
-    for uid in sorted(all_ids, key=lambda x: int(x) if x.isdigit() else x):
+    for uid in changed:
         row = rows_by_id.get(uid)
         if not row:
             row = current_row
             current_row += 1
+            rows_by_id[uid] = row
+        name, count = desired[uid]
         sheet.cell(row=row, column=header_map[config.EMPLOYEE_ID_COLUMN], value=uid)
-        sheet.cell(
-            row=row,
-            column=header_map[config.EMPLOYEE_NAME_COLUMN],
-            value=users_map.get(uid, f"User {uid}")
-        )
-        sheet.cell(row=row, column=header_map[config.COL_CK_OPERATOR], value=counts_responsible.get(uid, 0))
+        sheet.cell(row=row, column=header_map[config.EMPLOYEE_NAME_COLUMN], value=name)
+        sheet.cell(row=row, column=header_map[config.COL_CK_OPERATOR], value=count)
 
     wb.save(config.EXCEL_PATH)
+    return header_map, rows_by_id, sheet.max_row
+
+
+def write_rows_streaming(desired, changed):
+    headers = [
+        config.EMPLOYEE_ID_COLUMN,
+        config.EMPLOYEE_NAME_COLUMN,
+        config.COL_CK_OPERATOR,
+    ]
+    src = load_workbook(config.EXCEL_PATH, read_only=True)
+    dst = Workbook(write_only=True)
+    header_map = {}
+    rows_by_id = {}
+    max_row = 0
+    try:
+        for ws in src.worksheets:
+            out = dst.create_sheet(ws.title)
+            if ws.title != config.EXCEL_SHEET:
+                for values in ws.iter_rows(values_only=True):
+                    out.append(list(values))
+                continue
+            pending = set(changed)
+            width = 0
+            for row_idx, values in enumerate(ws.iter_rows(values_only=True), start=1):
+                values = list(values)
+                if row_idx == 1:
+                    header_map = {v: i + 1 for i, v in enumerate(values) if v}
+                    for name in headers:
+                        if name not in header_map:
+                            header_map[name] = len(header_map) + 1
+                    width = max(header_map.values())
+                    values += [None] * (width - len(values))
+                    for name, col in header_map.items():
+                        values[col - 1] = name
+                    out.append(values)
+                    max_row = row_idx
+                    continue
+                values += [None] * (width - len(values))
+                uid_value = values[header_map[config.EMPLOYEE_ID_COLUMN] - 1]
+                uid = str(uid_value) if uid_value is not None else None
+                if uid is not None:
+                    rows_by_id[uid] = row_idx
+                if uid in pending:
+                    pending.discard(uid)
+                    name, count = desired[uid]
+                    values[header_map[config.EMPLOYEE_NAME_COLUMN] - 1] = name
+                    values[header_map[config.COL_CK_OPERATOR] - 1] = count
+                out.append(values)
+                max_row = row_idx
+            for uid in changed:
+                if uid not in pending:
+                    continue
+                max_row += 1
+                values = [None] * width
+                name, count = desired[uid]
+                values[header_map[config.EMPLOYEE_ID_COLUMN] - 1] = uid
+                values[header_map[config.EMPLOYEE_NAME_COLUMN] - 1] = name
+                values[header_map[config.COL_CK_OPERATOR] - 1] = count
+                out.append(values)
+                rows_by_id[uid] = max_row
+    finally:
+        src.close()
+    tmp_path = f"{config.EXCEL_PATH}.tmp.xlsx"
+    dst.save(tmp_path)
+    os.replace(tmp_path, config.EXCEL_PATH)
+    return header_map, rows_by_id, max_row
+
+
+def write_counts_to_excel(users_map, counts_responsible):
+    desired = {
+        uid: [users_map.get(uid, f"User {uid}"), counts_responsible.get(uid, 0)]
+        for uid in counts_responsible
+    }
+    index = load_excel_index()
+    known = index["values"] if index else {}
+    changed = [
+        uid for uid in sorted(desired, key=lambda x: int(x) if x.isdigit() else x)
+        if known.get(uid) != desired[uid]
+    ]
+    if index and not changed:
+        log("Excel: no changes")
+        return
+
+    max_row = index["max_row"] if index else count_sheet_rows(config.EXCEL_PATH)
+    if max_row > config.EXCEL_STREAM_ROWS:
+        log(f"Excel: streaming rewrite, rows={max_row}, changed={len(changed)}")
+        header_map, rows_by_id, max_row = write_rows_streaming(desired, changed)
+    else:
+        log(f"Excel: in-place update, rows={max_row}, changed={len(changed)}")
+        header_map, rows_by_id, max_row = write_rows_inplace(desired, changed, index)
+
+    values = dict(known)
+    values.update({uid: desired[uid] for uid in changed})
+    save_excel_index(header_map, rows_by_id, values, max_row)
 
 
 def print_top(title: str, counter: Counter):
@@ -229,37 +561,94 @@ def print_top(title: str, counter: Counter):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="CK leads report from amoCRM")
+    parser.add_argument("--full", action="store_true", help="Ignore saved state and rescan all leads")
+    parser.add_argument("--shards", type=int, default=config.CK_SCAN_SHARDS,
+                        help="Split a full scan into N created_at ranges fetched in parallel (0 = sequential)")
+    parser.add_argument("--server-filter", action="store_true", default=config.CK_SERVER_FILTER,
+                        help="Ask amoCRM for CK leads only and rebuild the state from them")
+    args = parser.parse_args()
+
     client = AmoClient(config.AMO_BASE_URL, config.TOKENS_FILE)
     users_map = load_users_map(client)
     if not users_map:
         users_map = load_users_map_file()
         log(f"Users map fallback size: {len(users_map)}")
 
-    ck_total = 0
-    ck_responsible = Counter()
+    state = {"last_run": None, "leads": {}} if args.full else load_ck_state()
+    updated_from = None
+    extra_params = None
+    previous_ids = set()
+    if args.server_filter:
+        # Отфильтрованная выборка мала, поэтому каждый раз берём все ЦК-сделки целиком:
+        # так сделки, переставшие быть ЦК, выпадают из состояния без отдельного запроса.
+        extra_params = ck_filter_params()
+        previous_ids = {uid for uid in state["leads"].values() if uid}
+        state = {"last_run": None, "leads": {}}
+        print(f"Server-filtered scan: field {config.CK_FIELD_ID} = {config.CK_ENUM_ID}")
+    elif state["last_run"]:
+        updated_from = max(0, int(state["last_run"]) - config.CK_STATE_OVERLAP)
+        try:
+            deleted = fetch_deleted_lead_ids(client, updated_from)
+        except requests.RequestException as e:
+            # Без списка удалений инкремент оставил бы удалённые сделки в счёте навсегда
+            print(f"Deleted leads lookup failed ({e}), falling back to full scan")
+            state = {"last_run": None, "leads": {}}
+            updated_from = None
+        else:
+            dropped = [lead_id for lead_id in deleted if state["leads"].pop(lead_id, None) is not None]
+            print(f"Incremental scan: leads updated since {updated_from}, {len(dropped)} deleted CK leads dropped")
+    else:
+        print("Full scan: no saved CK state")
+    started_at = int(time.time())
+
+    ck_responsible = Counter(uid for uid in state["leads"].values() if uid)
 
     pages = 0
     processed = 0
+    changed = 0
+    unfiltered = 0
+
+    scan_stats = Counter()
+    if updated_from is None and args.shards > 0:
+        # С серверным фильтром воркеры отдают сделки как есть, иначе проверка unfiltered ниже ничего не увидит
+        leads_iter = iter_leads_sharded(
+            client, args.shards, config.CK_SCAN_WORKERS, lead_filter=None if extra_params else is_ck_lead,
+            scan_stats=scan_stats, extra_params=extra_params
+        )
+    else:
+        leads_iter = iter_leads(client, updated_from=updated_from, extra_params=extra_params)
 
-    for lead in iter_leads(client):
+    for lead in leads_iter:
         processed += 1
         if processed % 250 == 1:
             pages += 1
-        if not lead or lead.get("is_deleted"):
-            continue
-
-        if not is_ck_lead(lead):
+        if not lead:
             continue
-
-        ck_total += 1
-        responsible_id = str(lead.get("responsible_user_id") or "")
-        if responsible_id:
-            ck_responsible[responsible_id] += 1
-        log(f"CK lead id={lead.get('id')} responsible={responsible_id}")
+        if extra_params and not is_ck_lead(lead):
+            unfiltered += 1
+
+        before = state["leads"].get(str(lead.get("id") or ""))
+        if apply_lead(state["leads"], ck_responsible, lead):
+            responsible_id = state["leads"][str(lead.get("id"))]
+            log(f"CK lead id={lead.get('id')} responsible={responsible_id}")
+        if before != state["leads"].get(str(lead.get("id") or "")):
+            changed += 1
+
+    state["last_run"] = started_at
+    save_ck_state(state)
+    if scan_stats:
+        pages = scan_stats["pages"]
+        processed = scan_stats["leads"]
+    for uid in previous_ids:
+        ck_responsible.setdefault(uid, 0)
+    if unfiltered:
+        print(f"Warning: server filter returned {unfiltered} non-CK leads, CK filter may be unsupported")
 
     print(f"Pages fetched: {pages}")
     print(f"Leads processed: {processed}")
-    print(f"CK total: {ck_total}")
+    print(f"CK leads changed: {changed}")
+    print(f"CK total: {len(state['leads'])}")
     print_top("Top responsible", ck_responsible)
 
     write_counts_to_excel(users_map, ck_responsible)
@@ -0,0 +1,480 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# Стенд не должен ходить в боевые API: переопределяем окружение до импорта counter
+os.environ.setdefault("AMO_BASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("AMO_LONG_TOKEN", "bench")
+
+import counter  # noqa: E402
+
+SIP_PREFIX = "/api/shared"
+AMO_FIELD_MEETING_OK = int(counter.AMO_FIELD_MEETING_OK)
+AMO_FIELD_DEAL_SUM = int(counter.AMO_FIELD_DEAL_SUM)
+FIXTURE_NAMES = (
+    "users", "calls", "user_report", "user_report_history",
+    "amo_users", "amo_events", "amo_leads", "amo_lead_notes", "amo_contact_notes",
+)
+
+
+class Dataset:
+    def __init__(self, date_str: str, operators: int, calls: int, leads: int, seed: int,
+                 fixtures: Optional[Path] = None):
+        self.date_str = date_str
+        rnd = random.Random(seed)
+        day = counter.parse_date(date_str)
+        start_ts, _ = counter.amo_day_range(date_str)
+
+        self.users = [
+            {"id": 100 + i, "full_name": f"Оператор{i} Тестовый{i} Бенчевич", "role": "ROLE_OPERATOR"}
+            for i in range(operators)
+        ]
+        statuses = counter.STAT_FULL + ["1", "2", "3"]
+        self.calls = []
+        for i in range(calls):
+            user = rnd.choice(self.users)
+            started = datetime(day.year, day.month, day.day, 8, 0, 0) + timedelta(seconds=rnd.randint(0, 12 * 3600))
+            self.calls.append({
+                "id": 1_000_000 + i,
+                "operator": {"id": user["id"], "full_name": user["full_name"]},
+                "client_status": {"id": int(rnd.choice(statuses))},
+                "talk_duration": rnd.choice([0, 0, 5, 15, 25, 40, 90, 180, 400]),
+                "start_at": started.strftime("%d-%m-%Y %H:%M:%S"),
+            })
+        self.user_report = [
+            {"id": u["id"], "event": rnd.choice(list(counter.STATUS_MAP)),
+             "active": rnd.randint(0, 20000), "dnd": rnd.randint(0, 3000),
+             "call": rnd.randint(0, 15000), "ringing": rnd.randint(0, 2000)}
+            for u in self.users
+        ]
+        self.user_report_history = [{"id": u["id"], "event": "active"} for u in self.users]
+
+        self.amo_users = [{"id": u["id"], "name": u["full_name"]} for u in self.users]
+        self.amo_leads = []
+        self.amo_events = []
+        self.amo_lead_notes = []
+        self.amo_contact_notes = []
+        for i in range(leads):
+            lead_id = 5_000_000 + i
+            rid = rnd.choice(self.users)["id"]
+            ts = start_ts + rnd.randint(0, 86000)
+            status_id = int(rnd.choice([counter.AMO_STATUS_MEETING_DONE, counter.AMO_STATUS_DEAL_SUCCESS, "1", "2"]))
+            self.amo_leads.append({
+                "id": lead_id,
+                "responsible_user_id": rid,
+                "status_id": status_id,
+                "created_at": ts,
+                "updated_at": ts,
+                "custom_fields_values": [
+                    {"field_id": AMO_FIELD_MEETING_OK, "values": [{"value": rnd.random() < 0.3}]},
+                    {"field_id": AMO_FIELD_DEAL_SUM, "values": [{"value": str(rnd.randint(0, 500) * 1000)}]},
+                ],
+            })
+            self.amo_events.append({
+                "id": f"s{lead_id}", "type": "lead_status_changed", "entity_type": "lead",
+                "entity_id": lead_id, "created_by": rid, "created_at": ts,
+                "value_after": [{"lead_status": {"id": status_id, "pipeline_id": 1}}],
+            })
+            if rnd.random() < 0.5:
+                self.amo_events.append({
+                    "id": f"f{lead_id}", "type": f"custom_field_{AMO_FIELD_MEETING_OK}_value_changed",
+                    "entity_type": "lead", "entity_id": lead_id, "created_by": rid, "created_at": ts + 1,
+                    "value_after": [{"custom_field_value": {"field_id": AMO_FIELD_MEETING_OK, "text": "1"}}],
+                    "value_before": [],
+                })
+            for n in range(rnd.randint(0, 3)):
+                note_id = lead_id * 10 + n
+                entity_type = rnd.choice(["lead", "contact"])
+                note = {
+                    "id": note_id, "entity_id": lead_id, "responsible_user_id": rid,
+                    "note_type": rnd.choice(["call_in", "call_out"]),
+                    "created_at": ts + n, "updated_at": ts + n,
+                    "params": {"duration": rnd.choice([0, 10, 45, 61, 120, 600])},
+                }
+                (self.amo_lead_notes if entity_type == "lead" else self.amo_contact_notes).append(note)
+                self.amo_events.append({
+                    "id": f"n{note_id}", "type": note["note_type"].replace("call_in", "incoming_call").replace("call_out", "outgoing_call"),
+                    "entity_type": entity_type, "entity_id": lead_id, "created_at": ts + n,
+                    "value_after": [{"note": {"id": note_id}}],
+                })
+
+        if fixtures:
+            self.load_fixtures(fixtures)
+
+    def load_fixtures(self, path: Path) -> None:
+        for name in FIXTURE_NAMES:
+            file_path = path / f"{name}.json"
+            if not file_path.exists():
+                continue
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get("items") or next(iter(data.get("_embedded", {}).values()), [])
+            setattr(self, name, data)
+            print(f"Fixture {name}: {len(data)} items")
+
+
+class StubServer:
+    def __init__(self, dataset: Dataset, latency: float):
+        self.dataset = dataset
+        self.latency = latency
+        self.requests = Counter()
+        self.bytes = Counter()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.requests), sum(self.bytes.values())
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                return
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                if server.latency:
+                    time.sleep(server.latency)
+                status, body = server.route(parsed.path, query)
+                payload = b"" if body is None else json.dumps(body, ensure_ascii=False).encode("utf-8")
+                with server.lock:
+                    server.requests[parsed.path] += 1
+                    server.bytes[parsed.path] += len(payload)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                if payload:
+                    self.wfile.write(payload)
+
+        return Handler
+
+    def route(self, path: str, query: Dict[str, List[str]]):
+        ds = self.dataset
+        if path == f"{SIP_PREFIX}/user/list":
+            return 200, paginate_sip(ds.users, query)
+        if path == f"{SIP_PREFIX}/call/list":
+            items = ds.calls
+            operators = set(query.get("operators[]", []))
+            if operators:
+                items = [c for c in items if str(c["operator"]["id"]) in operators]
+            statuses = set(query.get("client_statuses[]", []))
+            if statuses:
+                items = [c for c in items if str(c["client_status"]["id"]) in statuses]
+            return 200, paginate_sip(items, query)
+        if path == f"{SIP_PREFIX}/user_report/list":
+            return 200, paginate_sip(ds.user_report, query)
+        if path == f"{SIP_PREFIX}/user_report/list/history":
+            return 200, paginate_sip(ds.user_report_history, query)
+        if path == f"{SIP_PREFIX}/campaign/list":
+            return 200, {"items": [{"id": 1}, {"id": 2}], "totalCount": 2}
+        if path == f"{SIP_PREFIX}/contact/list":
+            return 200, {"items": [], "totalCount": 1234}
+        if path == "/api/v4/users":
+            return paginate_amo("users", ds.amo_users, query)
+        if path == "/api/v4/events":
+            types = set(query.get("filter[type][]", []))
+            items = [e for e in ds.amo_events if not types or e["type"] in types]
+            return paginate_amo("events", filter_ts(items, query, "created_at"), query)
+        if path == "/api/v4/leads":
+            ids = set(query.get("filter[id][]", []))
+            items = [l for l in ds.amo_leads if not ids or str(l["id"]) in ids]
+            items = filter_ts(filter_ts(items, query, "created_at"), query, "updated_at")
+            return paginate_amo("leads", items, query)
+        if path in ("/api/v4/leads/notes", "/api/v4/contacts/notes"):
+            items = ds.amo_lead_notes if path.startswith("/api/v4/leads") else ds.amo_contact_notes
+            ids = set(query.get("filter[id][]", []))
+            if ids:
+                items = [n for n in items if str(n["id"]) in ids]
+            note_types = set(query.get("filter[note_type][]", []))
+            if note_types:
+                items = [n for n in items if n["note_type"] in note_types]
+            items = filter_ts(items, query, "updated_at")
+            return paginate_amo("notes", items, query)
+        return 404, {"error": "not found", "path": path}
+
+
+def paginate_sip(items, query):
+    page = int((query.get("page") or ["1"])[0])
+    limit = int((query.get("limit") or ["500"])[0])
+    return {"items": items[(page - 1) * limit:page * limit], "totalCount": len(items)}
+
+
+def paginate_amo(key, items, query):
+    page = int((query.get("page") or ["1"])[0])
+    limit = int((query.get("limit") or ["250"])[0])
+    chunk = items[(page - 1) * limit:page * limit]
+    if not chunk:
+        return 204, None
+    return 200, {"_page": page, "_embedded": {key: chunk}}
+
+
+def filter_ts(items, query, field):
+    lo = query.get(f"filter[{field}][from]")
+    hi = query.get(f"filter[{field}][to]")
+    if lo:
+        items = [i for i in items if int(i.get(field) or 0) >= int(lo[0])]
+    if hi:
+        items = [i for i in items if int(i.get(field) or 0) <= int(hi[0])]
+    return items
+
+
+def point_counter_at(base_url: str) -> None:
+    sip = f"{base_url}{SIP_PREFIX}"
+    counter.API_BASE = sip
+    counter.CALL_LIST_URL = f"{sip}/call/list"
+    counter.HIST_URL = f"{sip}/user_report/list/history"
+    counter.LIST_URL = f"{sip}/user_report/list"
+    counter.CONTACT_LIST_URL = f"{sip}/contact/list"
+    counter.CAMPAIGN_LIST_URL = f"{sip}/campaign/list"
+    counter.USERS_LIST_URL = f"{sip}/user/list"
+    counter.AMO_BASE_URL = base_url
+    counter.CK_SHEET_CSV_URL = ""
+    counter.TEST_DATE = None
+
+
+def measure(name: str, server: StubServer, fn) -> Dict[str, Any]:
+    before, bytes_before = server.snapshot()
+    tracemalloc.start()
+    started = time.perf_counter()
+    error = None
+    try:
+        fn()
+    except Exception as e:
+        error = str(e)
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after, bytes_after = server.snapshot()
+    delta = {path: after[path] - before.get(path, 0) for path in after if after[path] - before.get(path, 0)}
+    return {
+        "scenario": name,
+        "wall_s": round(wall, 3),
+        "requests": sum(delta.values()),
+        "requests_by_path": delta,
+        "response_kb": (bytes_after - bytes_before) // 1024,
+        "peak_mem_kb": peak // 1024,
+        "error": error,
+    }
+
+
+def reset_counter(db_dir: str, name: str) -> None:
+    """Холодный старт сценария: своя пустая база и сброшенные кэши процесса."""
+    counter.DB_PATH = os.path.join(db_dir, f"{name}.db")
+    if os.path.exists(counter.DB_PATH):
+        os.remove(counter.DB_PATH)
+    counter.init_db()
+    counter.OPERATORS.clear()
+    counter.AMO_USERS_CACHE.update(ts=0, data={})
+    counter.OPERATOR_STATE = counter.OperatorStatePoller(counter.LIVE_STATE_TTL)
+    counter.active_campaigns = []
+
+
+def run_scenarios(server: StubServer, dataset: Dataset, selected: List[str], report_days: int,
+                  db_dir: str) -> List[Dict[str, Any]]:
+    client = counter.app.test_client()
+    date_str = dataset.date_str
+    scenarios = {
+        "sync_day": lambda: counter.sync_day(date_str),
+        "stats_live": lambda: client.get("/stats"),
+        "stats_db": lambda: client.get(f"/stats?date={date_str}"),
+        "amo_leads_event_metrics": lambda: counter.amo_leads_event_metrics(date_str),
+        "amo_calls_over_minute": lambda: counter.amo_calls_over_minute(date_str),
+        "get_report_data": lambda: counter.get_report_data(
+            counter.format_date(counter.parse_date(date_str) - timedelta(days=report_days - 1)), date_str
+        ),
+    }
+
+    def fill_report_days():
+        # Отчёт меряем на заполненной базе, копируя один синк на несколько дней
+        counter.sync_day(date_str)
+        stats = counter.aggregate_calls(dataset.calls, operators_map=counter.OPERATORS)
+        end = counter.parse_date(date_str)
+        for offset in range(1, report_days):
+            counter.upsert_daily_stats(counter.format_date(end - timedelta(days=offset)), stats)
+
+    setups = {
+        "stats_db": lambda: counter.sync_day(date_str),
+        "get_report_data": fill_report_days,
+    }
+    results = []
+    for name in selected:
+        # Каждый сценарий стартует холодным: подготовка другого не прогревает ему кэши
+        reset_counter(db_dir, name)
+        if name in setups:
+            setups[name]()
+        results.append(measure(name, server, scenarios[name]))
+    return results
+
+
+def decoder_fixture_events() -> List[Dict[str, Any]]:
+    """Формы событий смены поля, которые встречались у amoCRM или разбираются эталоном."""
+    fid = AMO_FIELD_MEETING_OK
+    events = []
+    values = [True, False, 1, 0, "1", "0", "true", " Да ", "нет", "вкл.", "maybe", "", None, {"value": "yes"}, {"value": 0}, [1]]
+    for n, value in enumerate(values):
+        for key in ("value", "text", "enum_id"):
+            events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": n,
+                           "value_after": [{"custom_field_value": {"field_id": fid, key: value}}]})
+        events.append({"type": f"custom_field_{fid}_value_changed", "entity_type": "lead", "entity_id": n,
+                       "value_after": [{"custom_field_value": {"id": str(fid), "value": value}}]})
+        events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": n,
+                       "value_after": [{"field_id": fid, "values": [value]}]})
+        events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": n,
+                       "value_after": [{"field": {"id": fid}, "value": value}]})
+        events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": n,
+                       "value_after": {"custom_field_value": {"field_id": fid, "value": value}}})
+        events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": n,
+                       "field_id": fid, "value": value})
+    for other in (fid + 1, 0, "", None):
+        events.append({"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+                       "value_after": [{"custom_field_value": {"field_id": other, "id": fid, "value": True}}]})
+    events += [
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": [], "value_before": [{"custom_field_value": {"field_id": fid, "value": True}}]},
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": [], "value_before": {"custom_field_value": {"field_id": fid, "value": True}}},
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": [], "value_before": [{"custom_field_value": {"value": True}, "field_id": fid}]},
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": [], "value_before": []},
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": ["junk", {"custom_field_value": {"field_id": fid, "value": True}}]},
+        {"type": "custom_field_value_changed", "entity_type": "lead", "entity_id": 1,
+         "value_after": [{"custom_field_value": {"value": True}}], "value_before": [{"field_id": fid, "value": False}]},
+        {"type": "custom_field_value_changed", "entity_id": 1,
+         "value_after": [{"custom_field_value": {"field_id": fid, "value": True}}]},
+        {"type": "custom_field_value_changed", "entity_id": 1, "_embedded": {"entity": {"type": "contact"}},
+         "value_after": [{"custom_field_value": {"field_id": fid, "value": True}}]},
+        {"type": "custom_field_value_changed", "entity_type": "Contact", "entity_id": 1,
+         "value_after": [{"custom_field_value": {"field_id": fid, "value": True}}]},
+    ]
+    return events
+
+
+def check_event_decoder(dataset: Dataset, repeat: int = 20) -> bool:
+    """Сверяет быстрый декодер событий amoCRM с эталонным разбором и меряет оба."""
+    field_id = counter.AMO_FIELD_MEETING_OK
+    field_events = [e for e in dataset.amo_events if "custom_field" in str(e.get("type"))]
+    events = decoder_fixture_events() + field_events
+
+    def reference(event):
+        if not counter.amo_is_lead_event(event):
+            return "not-lead"
+        return counter.amo_field_flag(event, field_id)
+
+    decoder = counter.AmoFieldChangeDecoder(field_id)
+
+    def fast(event):
+        if not decoder.is_lead(event):
+            return "not-lead"
+        return decoder.field_flag(event)
+
+    mismatches = [(e, reference(e), fast(e)) for e in events if reference(e) != fast(e)]
+    # Порядок важен: кэш форм по типу не должен зависеть от того, какое событие пришло первым
+    decoder = counter.AmoFieldChangeDecoder(field_id)
+    mismatches += [(e, reference(e), fast(e)) for e in reversed(events) if reference(e) != fast(e)]
+    for event, want, got in mismatches[:10]:
+        print(f"MISMATCH reference={want!r} fast={got!r}: {json.dumps(event, ensure_ascii=False)}")
+    timings = {}
+    for name, fn in (("reference", reference), ("fast", fast)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for event in field_events:
+                fn(event)
+        timings[name] = (time.perf_counter() - started) / repeat
+    print(
+        f"Event decoder: {len(events)} events, {len(mismatches)} mismatches; "
+        f"{len(field_events)} field events: reference {timings['reference'] * 1000:.1f} ms, "
+        f"fast {timings['fast'] * 1000:.1f} ms"
+    )
+    return not mismatches
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    print(f"{'scenario':<26}{'wall, s':>10}{'requests':>10}{'recv, KB':>10}{'peak, KB':>12}")
+    for res in results:
+        print(
+            f"{res['scenario']:<26}{res['wall_s']:>10.3f}{res['requests']:>10}"
+            f"{res['response_kb']:>10}{res['peak_mem_kb']:>12}"
+        )
+        for path, count in sorted(res["requests_by_path"].items()):
+            print(f"    {path}: {count}")
+        if res["error"]:
+            print(f"    error: {res['error']}")
+
+
+def main() -> None:
+    scenario_names = [
+        "sync_day", "stats_live", "stats_db", "amo_leads_event_metrics", "amo_calls_over_minute", "get_report_data",
+    ]
+    parser = argparse.ArgumentParser(description="Benchmark against a local SipSpeak/amoCRM stand-in")
+    parser.add_argument("--date", default=(datetime.now() - timedelta(days=1)).strftime("%d-%m-%Y"))
+    parser.add_argument("--operators", type=int, default=40)
+    parser.add_argument("--calls", type=int, default=20000, help="SipSpeak calls for the day")
+    parser.add_argument("--leads", type=int, default=3000, help="amoCRM leads touched during the day")
+    parser.add_argument("--latency", type=float, default=0.05, help="Added latency per request, seconds")
+    parser.add_argument("--amo-rate", type=float, default=0, help="amoCRM limiter rate (0 = unlimited)")
+    parser.add_argument("--report-days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fixtures", type=Path, help="Directory with recorded <name>.json responses")
+    parser.add_argument("--scenario", action="append", choices=scenario_names, help="Run only these scenarios")
+    parser.add_argument("--json", type=Path, help="Write results to this file")
+    parser.add_argument("--db", help="Directory for per-scenario SQLite files (default: fresh temp dir)")
+    parser.add_argument("--check-decoder", action="store_true",
+                        help="Only compare the fast amoCRM event decoder with the reference parser and exit")
+    args = parser.parse_args()
+
+    if args.check_decoder:
+        dataset = Dataset(args.date, args.operators, 0, args.leads, args.seed, fixtures=args.fixtures)
+        raise SystemExit(0 if check_event_decoder(dataset) else 1)
+
+    db_dir = args.db or tempfile.mkdtemp(prefix="cc_bench_")
+    os.makedirs(db_dir, exist_ok=True)
+
+    dataset = Dataset(args.date, args.operators, args.calls, args.leads, args.seed, fixtures=args.fixtures)
+    server = StubServer(dataset, args.latency).start()
+    point_counter_at(server.base_url)
+    counter.AMO_LIMITER.rate = args.amo_rate
+    print(f"Stand-in API: {server.base_url}, DB dir: {db_dir}")
+    try:
+        results = run_scenarios(server, dataset, args.scenario or scenario_names, args.report_days, db_dir)
+    finally:
+        server.stop()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List
+
+from bench import point_counter_at
+
+import counter
+
+
+def generate(db_path: str, days: int, operators: int, moscow: int, excluded: int, end: date, seed: int) -> Dict[str, List[str]]:
+    rnd = random.Random(seed)
+    ids = [str(1000 + i) for i in range(operators)]
+    moscow_ids = ids[:moscow]
+    excluded_ids = ids[moscow:moscow + excluded]
+    names = {oid: f"Фамилия{oid} Имя{oid} Отчество" for oid in ids}
+    # У каждого оператора своя «сила», чтобы распределения не были одинаковыми
+    skill = {oid: rnd.uniform(0.5, 1.5) for oid in ids}
+
+    counter.DB_PATH = db_path
+    counter.init_db()
+    conn = counter.db_connection()
+    try:
+        conn.execute("DELETE FROM daily_operator_stats")
+        conn.execute("DELETE FROM sync_state")
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        start = end - timedelta(days=days - 1)
+        batch = []
+        d = start
+        while d <= end:
+            date_str = counter.format_date(d)
+            weekend = d.weekday() >= 5
+            for oid in ids:
+                # Часть операторов в конкретный день не работает
+                if rnd.random() < (0.6 if weekend else 0.12):
+                    continue
+                k = skill[oid] * (0.4 if weekend else 1.0)
+                if oid in moscow_ids:
+                    all_calls = total = cs8 = cs20 = cs22 = lead_agent = line = ck = talk_sum = talk_count = 0
+                    amo_calls_1m = int(rnd.gauss(25, 8) * k)
+                    amo_agreements = rnd.randint(0, 4)
+                    amo_meetings = rnd.randint(0, 3)
+                    amo_deals = rnd.randint(0, 1)
+                    amo_revenue = amo_deals * rnd.randint(50, 900) * 1000
+                else:
+                    all_calls = max(0, int(rnd.gauss(220, 60) * k))
+                    total = int(all_calls * rnd.uniform(0.15, 0.35))
+                    cs8 = int(total * rnd.uniform(0.02, 0.08))
+                    cs20 = int(total * rnd.uniform(0.01, 0.05))
+                    cs22 = int(total * rnd.uniform(0.0, 0.03))
+                    lead_agent = cs22 + int(total * rnd.uniform(0.0, 0.02))
+                    line = int(rnd.uniform(4, 8) * 3600 * min(k, 1.0))
+                    ck = rnd.randint(0, 3)
+                    talk_count = total
+                    talk_sum = int(talk_count * rnd.uniform(45, 160))
+                    amo_calls_1m = amo_agreements = amo_meetings = amo_deals = amo_revenue = 0
+                batch.append((
+                    date_str, oid, names[oid], all_calls, total, cs8, cs20, cs22, lead_agent, line, ck,
+                    amo_calls_1m, amo_agreements, amo_meetings, amo_deals, amo_revenue, talk_sum, talk_count, now,
+                ))
+            d += timedelta(days=1)
+            if len(batch) >= 20000:
+                insert_rows(conn, batch)
+                batch = []
+        insert_rows(conn, batch)
+        counter.rebuild_sync_state(conn)
+        conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            ("nightly_sync_days", "7"),
+        )
+        conn.commit()
+        rows = conn.execute("SELECT COUNT(*) AS c FROM daily_operator_stats").fetchone()["c"]
+    finally:
+        conn.close()
+    print(f"Generated {rows} rows: {days} days x {operators} operators ({moscow} Moscow, {excluded} excluded)")
+    return {"moscow": moscow_ids, "excluded": excluded_ids}
+
+
+def insert_rows(conn, batch) -> None:
+    if not batch:
+        return
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO daily_operator_stats
+        (date, operator_id, operator_name, all_calls, total_calls, cs8_calls, cs20_calls, cs22_calls, lead_agent_calls, line_calls, ck_lead_calls, amo_calls_1m, amo_agreements, amo_meetings, amo_deals, amo_revenue, talk_sum, talk_count, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        batch,
+    )
+
+
+def timed(fn: Callable, repeat: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {
+        "min_ms": round(min(samples) * 1000, 1),
+        "median_ms": round(statistics.median(samples) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+
+def run_scenarios(end: date, days: int, repeat: int) -> None:
+    client = counter.app.test_client()
+    end_str = counter.format_date(end)
+    month_str = counter.format_date(end - timedelta(days=29))
+    year_str = counter.format_date(end - timedelta(days=min(days, 365) - 1))
+    all_str = counter.format_date(end - timedelta(days=days - 1))
+    rnd = random.Random(0)
+    sample_days = [counter.format_date(end - timedelta(days=rnd.randint(0, days - 1))) for _ in range(repeat)]
+    day_iter = iter(sample_days * 2)
+
+    scenarios = [
+        ("/report/data month", lambda: client.get(f"/report/data?start={month_str}&end={end_str}")),
+        ("/report/data year", lambda: client.get(f"/report/data?start={year_str}&end={end_str}")),
+        ("/report/data all", lambda: client.get(f"/report/data?start={all_str}&end={end_str}")),
+        ("/report/data no range", lambda: client.get("/report/data")),
+        ("/report/data moscow year", lambda: client.get(f"/report/data?start={year_str}&end={end_str}&branch=moscow")),
+        ("/report/export month", lambda: client.get(f"/report/export?start={month_str}&end={end_str}")),
+        ("/report/export year", lambda: client.get(f"/report/export?start={year_str}&end={end_str}")),
+        ("get_day_stats_from_db", lambda: counter.get_day_stats_from_db(next(day_iter))),
+        ("list_saved_dates", counter.list_saved_dates),
+    ]
+    print(f"{'scenario':<28}{'min, ms':>10}{'median, ms':>12}{'max, ms':>10}")
+    for name, fn in scenarios:
+        res = timed(fn, repeat)
+        print(f"{name:<28}{res['min_ms']:>10}{res['median_ms']:>12}{res['max_ms']:>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthetic daily_operator_stats generator and DB timing scenarios")
+    parser.add_argument("--db", help="SQLite file (default: fresh temp file)")
+    parser.add_argument("--days", type=int, default=3 * 365)
+    parser.add_argument("--operators", type=int, default=300)
+    parser.add_argument("--moscow", type=int, default=30, help="How many operators are treated as Moscow")
+    parser.add_argument("--excluded", type=int, default=5, help="How many operators are excluded from reports")
+    parser.add_argument("--end", help="Last generated date, dd-mm-YYYY (default: yesterday)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-generate", action="store_true", help="Only run timings against an existing --db")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="cc_bench_db_"), "bench.db")
+    end = counter.parse_date(args.end) if args.end else date.today() - timedelta(days=1)
+    # Все внешние вызовы уходят в заведомо закрытый порт
+    point_counter_at("http://127.0.0.1:9")
+    if args.skip_generate:
+        counter.DB_PATH = db_path
+        counter.init_db()
+        groups = {"moscow": [], "excluded": []}
+    else:
+        started = time.perf_counter()
+        groups = generate(db_path, args.days, args.operators, args.moscow, args.excluded, end, args.seed)
+        print(f"Generation took {time.perf_counter() - started:.1f}s, DB: {db_path}")
+    if groups["moscow"]:
+        counter.MOSCOW_OPERATOR_IDS = set(groups["moscow"])
+        counter.MOSCOW_SIPSPEAK_AGREEMENTS_IDS = set(groups["moscow"][:1])
+    if groups["excluded"]:
+        counter.EXCLUDED_OPERATOR_IDS = set(groups["excluded"])
+    run_scenarios(end, args.days, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
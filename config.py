@@ -5,15 +5,23 @@ CLIENT_ID = os.getenv("CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "https://investagregator73.ru/amo/callback")
 AMO_DEBUG = os.getenv("AMO_DEBUG", "1") == "1"
+AMO_RATE_LIMIT = float(os.getenv("AMO_RATE_LIMIT", "7"))
 
 TOKENS_FILE = os.getenv("TOKENS_FILE", "tokens.json")
 USERS_MAP_FILE = os.getenv("USERS_MAP_FILE", "users_map.json")
+CK_STATE_FILE = os.getenv("CK_STATE_FILE", "ck_state.json")
+CK_STATE_OVERLAP = int(os.getenv("CK_STATE_OVERLAP", "300"))
 
 CK_FIELD_ID = int(os.getenv("CK_FIELD_ID", "942511"))
 CK_ENUM_ID = int(os.getenv("CK_ENUM_ID", "3619433"))
+CK_SERVER_FILTER = os.getenv("CK_SERVER_FILTER", "0") == "1"
+CK_SCAN_SHARDS = int(os.getenv("CK_SCAN_SHARDS", "16"))
+CK_SCAN_WORKERS = int(os.getenv("CK_SCAN_WORKERS", "4"))
 
 EXCEL_PATH = os.getenv("EXCEL_PATH", "report.xlsx")
 EXCEL_SHEET = os.getenv("EXCEL_SHEET", "Sheet1")
+EXCEL_INDEX_FILE = os.getenv("EXCEL_INDEX_FILE", f"{EXCEL_PATH}.index.json")
+EXCEL_STREAM_ROWS = int(os.getenv("EXCEL_STREAM_ROWS", "20000"))
 EMPLOYEE_ID_COLUMN = os.getenv("EMPLOYEE_ID_COLUMN", "ID сотрудника")
 EMPLOYEE_NAME_COLUMN = os.getenv("EMPLOYEE_NAME_COLUMN", "Сотрудник")
 
@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, render_template, request, send_file, redirect
+from flask import Flask, Response, g, jsonify, render_template, request, send_file, redirect
 import requests
 import json
 from datetime import datetime, timedelta
@@ -6,15 +6,26 @@ import pytz
 from collections import Counter, defaultdict
 from apscheduler.schedulers.background import BackgroundScheduler
 import os
+import atexit
 import threading
 import inspect
 import re
 import time
 import sqlite3
+import uuid
 import io
 import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from openpyxl import Workbook
 
+import metrics
+import slowlog
+from leader import LeaderLease
+from operator_stats import StatsTable
+from profiler import PROFILER
+from rate_limit import TokenBucket, retry_after_seconds
+
 app = Flask(__name__)
 
 def load_env():
@@ -66,6 +77,16 @@ AMO_STATUS_DEAL_SUCCESS = str(os.getenv("AMO_STATUS_DEAL_SUCCESS", "142"))
 AMO_FIELD_MEETING_OK = str(os.getenv("AMO_FIELD_MEETING_OK", "964369"))
 AMO_FIELD_DEAL_SUM = str(os.getenv("AMO_FIELD_DEAL_SUM", "964601"))
 AMO_DEBUG_EVENTS = os.getenv("AMO_DEBUG_EVENTS", "").lower() in ("1", "true", "yes", "y")
+AMO_RATE_LIMIT = float(os.getenv("AMO_RATE_LIMIT", "7"))  # запросов в секунду на интеграцию
+AMO_MAX_RETRIES = int(os.getenv("AMO_MAX_RETRIES", "5"))
+AMO_LIMITER = TokenBucket(AMO_RATE_LIMIT)
+AMO_LEAD_CACHE_TTL = int(os.getenv("AMO_LEAD_CACHE_TTL", str(7 * 86400)))
+AMO_LEAD_CACHE_OVERLAP = 300  # секунд перекрытия окна событий между проверками
+AMO_NOTES_WORKERS = int(os.getenv("AMO_NOTES_WORKERS", "4"))
+AMO_NOTES_DIRECT = os.getenv("AMO_NOTES_DIRECT", "1").lower() in ("1", "true", "yes", "y")
+AMO_TODAY_TILE_TTL = int(os.getenv("AMO_TODAY_TILE_TTL", "60"))
+SIP_COUNT_WORKERS = int(os.getenv("SIP_COUNT_WORKERS", "8"))
+AMO_NOTES_GRACE_DAYS = int(os.getenv("AMO_NOTES_GRACE_DAYS", "3"))  # сколько дней после дня ждём правок его заметок
 
 MOSCOW_OPERATOR_IDS = {oid.strip() for oid in (os.getenv("MOSCOW_OPERATOR_IDS", "38").split(",")) if oid.strip()}
 MOSCOW_SIPSPEAK_AGREEMENTS_IDS = {oid.strip() for oid in (os.getenv("MOSCOW_SIPSPEAK_AGREEMENTS_IDS", "38").split(",")) if oid.strip()}
@@ -77,6 +98,18 @@ NIGHTLY_SYNC_DAYS = int(os.getenv("CALLCENTER_NIGHTLY_SYNC_DAYS", "0") or 0)
 # === База данных ===
 DB_PATH = os.getenv("CALLCENTER_DB_PATH", os.path.join(app.root_path, "data", "callcenter.db"))
 ADMIN_TOKEN = os.getenv("CALLCENTER_ADMIN_TOKEN", "")
+SLOW_REQUEST_MS = int(os.getenv("CALLCENTER_SLOW_REQUEST_MS", "2000"))
+slowlog.configure(int(os.getenv("CALLCENTER_SLOW_LOG_SIZE", "200")))
+PROFILE_DIR = os.getenv("CALLCENTER_PROFILE_DIR", os.path.join(os.path.dirname(DB_PATH), "profiles"))
+PROFILE_MAX_SECONDS = int(os.getenv("CALLCENTER_PROFILE_MAX_SECONDS", "300"))
+SYNC_RUNS_KEEP = int(os.getenv("CALLCENTER_SYNC_RUNS_KEEP", "2000"))
+LIVE_STATE_TTL = int(os.getenv("CALLCENTER_LIVE_STATE_TTL", "15"))
+SCHEDULER_LEASE_TTL = int(os.getenv("CALLCENTER_SCHEDULER_LEASE_TTL", "60"))
+# Запуск планировщика при импорте — для WSGI-воркеров; CLI-скрипты импортируют модуль без него
+SCHEDULER_AUTOSTART = os.getenv("CALLCENTER_SCHEDULER", "0").lower() in ("1", "true", "yes", "y")
+BACKFILL_JOBS_KEEP = int(os.getenv("CALLCENTER_BACKFILL_JOBS_KEEP", "50"))
+BACKFILL_RETRY_SECONDS = int(os.getenv("CALLCENTER_BACKFILL_RETRY_SECONDS", "300"))
+BACKFILL_STALE_SECONDS = int(os.getenv("CALLCENTER_BACKFILL_STALE_SECONDS", "900"))
 
 
 # === Операторы и статус-маппинг ===
@@ -95,13 +128,15 @@ STATUS_MAP = {
     "working_day":"Рабочий день"
 }
 
-ALL_CALLS_PARAMS = [("page",1), ("limit",10000)]
+COUNT_ONLY_PARAMS = [("page",1), ("limit",1)]
 STAT_FULL = ["8","9","10","11","13","14","15","16","20","21","22","23","24","25","30","34","35"]
 CS8        = ["8"]
 CS20       = ["20"]
 CS22       = ["22"]
 LEAD_AGENT = ["22","30"]
 
+CALL_HOUR_RE = re.compile(r"(?:^|[ T])(\d{1,2}):\d{2}")
+
 def get_talk_duration(call):
     td = call.get("talk_duration") or 0
     try:
@@ -113,6 +148,16 @@ def get_status_id(call):
     status_obj = call.get("client_status") or {}
     return str(status_obj.get("id") or "")
 
+def get_call_time(call):
+    return str(call.get("start_at") or call.get("started_at") or call.get("created_at") or "")
+
+def get_call_hour(started_at):
+    match = CALL_HOUR_RE.search(started_at or "")
+    if not match:
+        return None
+    hour = int(match.group(1))
+    return hour if hour < 24 else None
+
 # для тестирования локально:
 TEST_DATE = os.getenv("TEST_DATE")  # e.g. "14-05-2025"
 
@@ -179,7 +224,27 @@ def amo_enabled():
 
 def amo_get(path, params=None):
     url = f"{AMO_BASE_URL}{path}"
-    return requests.get(url, headers=AMO_HEADERS, params=params, timeout=REQUEST_TIMEOUT)
+    retry = 0
+    while True:
+        AMO_LIMITER.acquire()
+        r = metrics.observe(
+            "amocrm", path,
+            lambda: requests.get(url, headers=AMO_HEADERS, params=params, timeout=REQUEST_TIMEOUT)
+        )
+        if r.status_code != 429 or retry >= AMO_MAX_RETRIES:
+            return r
+        delay = retry_after_seconds(r, default=1 + retry)
+        print(f"AMO 429 {path}: retry after {delay:.1f}s")
+        metrics.record_retry("amocrm", path)
+        AMO_LIMITER.penalize(delay)
+        retry += 1
+
+def sip_get(url, params=None):
+    endpoint = url[len(API_BASE):] if url.startswith(API_BASE) else url
+    return metrics.observe(
+        "sipspeak", endpoint,
+        lambda: requests.get(url, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    )
 
 def amo_users_fallback():
     path = os.path.join(app.root_path, "users_map.json")
@@ -338,143 +403,238 @@ def amo_events_call_notes(date_str):
         "contacts": list(dict.fromkeys(contact_note_ids))
     }
 
-def amo_fetch_notes(entity_type, note_ids):
-    if not note_ids:
+def amo_fetch_notes_chunk(entity_type, chunk):
+    params = [("limit", 250)]
+    for note_id in chunk:
+        params.append(("filter[id][]", note_id))
+    try:
+        r = amo_get(f"/api/v4/{entity_type}/notes", params=params)
+    except requests.RequestException as e:
+        print(f"AMO notes request error: {e}")
         return []
-    endpoint = f"/api/v4/{entity_type}/notes"
-    notes = []
-    chunk_size = 200
-    for i in range(0, len(note_ids), chunk_size):
-        chunk = note_ids[i:i+chunk_size]
-        params = [("limit", 250)]
-        for note_id in chunk:
-            params.append(("filter[id][]", note_id))
-        try:
-            r = amo_get(endpoint, params=params)
-        except requests.RequestException as e:
-            print(f"AMO notes request error: {e}")
-            continue
-        if r.status_code != 200:
-            print(f"AMO notes HTTP {r.status_code}: {r.text}")
-            continue
-        data = r.json()
-        batch = data.get("_embedded", {}).get("notes", []) or []
-        notes.extend(batch)
-    return notes
+    if r.status_code != 200:
+        print(f"AMO notes HTTP {r.status_code}: {r.text}")
+        return []
+    data = r.json()
+    return data.get("_embedded", {}).get("notes", []) or []
 
-def amo_calls_over_minute(date_str):
-    if not amo_enabled():
-        return Counter()
-    note_ids = amo_events_call_notes(date_str)
-    lead_notes = amo_fetch_notes("leads", note_ids["leads"])
-    contact_notes = amo_fetch_notes("contacts", note_ids["contacts"])
-    counts = Counter()
+def amo_long_call_owner(note):
+    note_type = note.get("note_type") or ""
+    if note_type not in ("call_in", "call_out"):
+        return None
+    params = note.get("params") or {}
+    try:
+        duration = int(params.get("duration") or 0)
+    except (TypeError, ValueError):
+        duration = 0
+    if duration < AMO_CALL_MIN_SECONDS:
+        return None
+    return str(note.get("responsible_user_id") or "") or None
 
-    def handle(note):
-        note_type = note.get("note_type") or ""
-        if note_type not in ("call_in", "call_out"):
-            return
-        params = note.get("params") or {}
-        try:
-            duration = int(params.get("duration") or 0)
-        except (TypeError, ValueError):
-            duration = 0
-        if duration < AMO_CALL_MIN_SECONDS:
-            return
-        rid = str(note.get("responsible_user_id") or "")
-        if rid:
-            counts[rid] += 1
+def amo_count_long_calls(note_ids):
+    """Считает звонки от AMO_CALL_MIN_SECONDS по ответственным.
+
+    Чанки заметок сделок и контактов запрашиваются параллельно (общий
+    AMO_LIMITER держит лимит amoCRM), фильтр применяется к каждому чанку по
+    мере прихода — полные списки заметок в памяти не собираются.
+    """
+    chunk_size = 200
+    tasks = []
+    for entity_type in ("leads", "contacts"):
+        ids = note_ids.get(entity_type) or []
+        for i in range(0, len(ids), chunk_size):
+            tasks.append((entity_type, ids[i:i+chunk_size]))
+    counts = Counter()
+    if not tasks:
+        return counts
 
-    for note in lead_notes:
-        handle(note)
-    for note in contact_notes:
-        handle(note)
-    print(f"AMO calls >= {AMO_CALL_MIN_SECONDS}s {date_str}: {sum(counts.values())}")
+    def count_chunk(entity_type, chunk):
+        out = Counter()
+        for note in amo_fetch_notes_chunk(entity_type, chunk):
+            rid = amo_long_call_owner(note)
+            if rid:
+                out[rid] += 1
+        return out
+
+    worker = metrics.propagate(count_chunk)
+    with ThreadPoolExecutor(max_workers=max(1, min(AMO_NOTES_WORKERS, len(tasks)))) as pool:
+        futures = [pool.submit(worker, entity_type, chunk) for entity_type, chunk in tasks]
+        for future in as_completed(futures):
+            counts.update(future.result())
     return counts
 
-def amo_events_call_notes_range(start_date, end_date):
-    if not amo_enabled():
-        return {"leads": [], "contacts": []}
-    start_ts, end_ts = amo_range_timestamps(start_date, end_date)
-    if not start_ts or not end_ts:
-        return {"leads": [], "contacts": []}
-    lead_note_ids = []
-    contact_note_ids = []
-    page = 1
-    total = 0
-    while True:
-        params = [
-            ("limit", 250),
-            ("page", page),
-            ("filter[type][]", "incoming_call"),
-            ("filter[type][]", "outgoing_call"),
-            ("filter[created_at][from]", start_ts),
-            ("filter[created_at][to]", end_ts),
-        ]
-        try:
-            r = amo_get("/api/v4/events", params=params)
-        except requests.RequestException as e:
-            print(f"AMO events request error: {e}")
-            break
-        if r.status_code != 200:
-            print(f"AMO events HTTP {r.status_code}: {r.text}")
-            break
-        data = r.json()
-        events = data.get("_embedded", {}).get("events", []) or []
-        if not events:
-            break
-        for event in events:
-            total += 1
-            note_id = None
-            for item in (event.get("value_after") or []):
-                note = item.get("note") or {}
+def amo_long_calls_by_day_direct(start_ts, end_ts):
+    """Считает длинные звонки прямым запросом заметок call_in/call_out, созданных в [start_ts, end_ts].
+
+    Заметки сделок и контактов листаются параллельно и раскладываются по дню
+    создания (day_key в AMO_TZ). amoCRM фильтрует заметки только по
+    updated_at, поэтому окно выборки — от start_ts до end_ts плюс
+    AMO_NOTES_GRACE_DAYS: заметку, изменённую позже (например, приложили
+    запись), старый день не увидит. Возвращает None, если amoCRM не отдал
+    список (тогда вызывающий идёт старым путём через /api/v4/events).
+    """
+    tz = pytz.timezone(AMO_TZ)
+
+    def scan(entity_type):
+        out = defaultdict(Counter)
+        seen = set()
+        page = 1
+        while True:
+            params = [
+                ("limit", 250),
+                ("page", page),
+                ("filter[note_type][]", "call_in"),
+                ("filter[note_type][]", "call_out"),
+                # updated_at >= created_at всегда, а после конца окна заметку правят редко
+                ("filter[updated_at][from]", start_ts),
+                ("filter[updated_at][to]", end_ts + AMO_NOTES_GRACE_DAYS * 86400),
+            ]
+            r = amo_get(f"/api/v4/{entity_type}/notes", params=params)
+            if r.status_code == 204:
+                break
+            if r.status_code != 200:
+                raise requests.HTTPError(f"AMO {entity_type} notes HTTP {r.status_code}: {r.text}", response=r)
+            notes = r.json().get("_embedded", {}).get("notes", []) or []
+            if not notes:
+                break
+            for note in notes:
                 note_id = note.get("id")
-                if note_id:
-                    break
-            if not note_id:
-                continue
-            entity_type = event.get("entity_type")
-            if entity_type == "lead":
-                lead_note_ids.append(note_id)
-            elif entity_type == "contact":
-                contact_note_ids.append(note_id)
-        page += 1
-    print(f"AMO call events {start_date}..{end_date}: {total}")
-    return {
-        "leads": list(dict.fromkeys(lead_note_ids)),
-        "contacts": list(dict.fromkeys(contact_note_ids))
-    }
+                if note_id in seen:
+                    continue
+                seen.add(note_id)
+                # Выборка по updated_at шире нужного, границу по created_at проверяем здесь
+                created_at = int(note.get("created_at") or 0)
+                if created_at < start_ts or created_at > end_ts:
+                    continue
+                rid = amo_long_call_owner(note)
+                if rid:
+                    day_key = int(datetime.fromtimestamp(created_at, tz).strftime("%Y%m%d"))
+                    out[day_key][rid] += 1
+            if len(notes) < 250:
+                break
+            page += 1
+        return out
+
+    worker = metrics.propagate(scan)
+    by_day = defaultdict(Counter)
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for result in pool.map(worker, ("leads", "contacts")):
+                for day_key, counts in result.items():
+                    by_day[day_key].update(counts)
+    except (requests.RequestException, ValueError) as e:
+        print(f"AMO direct notes query failed, falling back to events: {e}")
+        return None
+    return by_day
+
+def amo_store_call_tile(conn, d, counts, final):
+    day_key = int(d.strftime("%Y%m%d"))
+    conn.execute("DELETE FROM amo_tile_calls WHERE day_key = ?", (day_key,))
+    conn.executemany(
+        "INSERT INTO amo_tile_calls (day_key, operator_id, calls_1m) VALUES (?, ?, ?)",
+        [(day_key, oid, value) for oid, value in counts.items() if value]
+    )
+    conn.execute(
+        """
+        INSERT INTO amo_day_tiles (day_key, date, final, fetched_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day_key) DO UPDATE SET date=excluded.date, final=excluded.final, fetched_at=excluded.fetched_at
+        """,
+        (day_key, format_date(d), 1 if final else 0, time.time())
+    )
+
+def amo_fill_call_tiles(days, today):
+    """Догружает звонки от минуты за дни days и сохраняет их дневными тайлами.
+
+    Прямой запрос заметок одним проходом покрывает все дни от первого до
+    последнего из days, и тайлы сохраняются для каждого из них. Без него — по
+    запросу событий на день; день, на котором не все запросы к amoCRM прошли
+    успешно, не сохраняется. Возвращает {day_key: Counter} для days.
+    """
+    fetched = {}
+    by_day = None
+    if AMO_NOTES_DIRECT:
+        start_ts, _ = amo_day_range(format_date(days[0]))
+        _, end_ts = amo_day_range(format_date(days[-1]))
+        by_day = amo_long_calls_by_day_direct(start_ts, end_ts)
+    conn = db_connection()
+    try:
+        if by_day is not None:
+            d = days[0]
+            while d <= days[-1]:
+                counts = by_day.get(int(d.strftime("%Y%m%d")), Counter())
+                amo_store_call_tile(conn, d, counts, final=d < today)
+                fetched[int(d.strftime("%Y%m%d"))] = counts
+                d += timedelta(days=1)
+        else:
+            for d in days:
+                with metrics.capture() as calls:
+                    counts = amo_count_long_calls(amo_events_call_notes(format_date(d)))
+                if all(call["status"].startswith("2") for call in calls if call["upstream"] == "amocrm"):
+                    amo_store_call_tile(conn, d, counts, final=d < today)
+                else:
+                    print(f"AMO calls tile {format_date(d)}: incomplete, not cached")
+                fetched[int(d.strftime("%Y%m%d"))] = counts
+        conn.commit()
+    finally:
+        conn.close()
+    return {int(d.strftime("%Y%m%d")): fetched[int(d.strftime("%Y%m%d"))] for d in days}
 
 def amo_calls_over_minute_range(start_date, end_date):
+    """Звонки от минуты по ответственным за период, из дневных тайлов.
+
+    Звонок датируется созданием заметки, поэтому тайл дня, снятый после его
+    конца, не меняется и больше не запрашивается. Сегодняшний (и снятый, пока
+    день ещё шёл) обновляется, если старше AMO_TODAY_TILE_TTL.
+    """
     if not amo_enabled():
         return Counter()
-    note_ids = amo_events_call_notes_range(start_date, end_date)
-    lead_notes = amo_fetch_notes("leads", note_ids["leads"])
-    contact_notes = amo_fetch_notes("contacts", note_ids["contacts"])
-    counts = Counter()
-
-    def handle(note):
-        note_type = note.get("note_type") or ""
-        if note_type not in ("call_in", "call_out"):
-            return
-        params = note.get("params") or {}
-        try:
-            duration = int(params.get("duration") or 0)
-        except (TypeError, ValueError):
-            duration = 0
-        if duration < AMO_CALL_MIN_SECONDS:
-            return
-        rid = str(note.get("responsible_user_id") or "")
-        if rid:
-            counts[rid] += 1
+    start = parse_date(start_date)
+    end = parse_date(end_date)
+    if start > end:
+        start, end = end, start
+    today = datetime.now(pytz.timezone(AMO_TZ)).date()
+    key_range = (int(start.strftime("%Y%m%d")), int(end.strftime("%Y%m%d")))
+    now = time.time()
+    conn = db_connection()
+    try:
+        stored = {
+            row["day_key"]: row
+            for row in conn.execute(
+                "SELECT day_key, final, fetched_at FROM amo_day_tiles WHERE day_key BETWEEN ? AND ?", key_range
+            )
+        }
+    finally:
+        conn.close()
+    missing = []
+    d = start
+    while d <= end and d <= today:
+        row = stored.get(int(d.strftime("%Y%m%d")))
+        if row is None or (not row["final"] and now - row["fetched_at"] >= AMO_TODAY_TILE_TTL):
+            missing.append(d)
+        d += timedelta(days=1)
+    fetched = amo_fill_call_tiles(missing, today) if missing else {}
 
-    for note in lead_notes:
-        handle(note)
-    for note in contact_notes:
-        handle(note)
-    print(f"AMO calls >= {AMO_CALL_MIN_SECONDS}s {start_date}..{end_date}: {sum(counts.values())}")
+    counts = Counter()
+    conn = db_connection()
+    try:
+        for row in conn.execute(
+            "SELECT day_key, operator_id, calls_1m FROM amo_tile_calls WHERE day_key BETWEEN ? AND ?", key_range
+        ):
+            if row["day_key"] not in fetched:
+                counts[row["operator_id"]] += row["calls_1m"]
+    finally:
+        conn.close()
+    for day_counts in fetched.values():
+        counts.update(day_counts)
+    print(
+        f"AMO calls >= {AMO_CALL_MIN_SECONDS}s {format_date(start)}..{format_date(end)}: "
+        f"{sum(counts.values())} ({len(missing)} days fetched)"
+    )
     return counts
 
+def amo_calls_over_minute(date_str):
+    return amo_calls_over_minute_range(date_str, date_str)
+
 def amo_leads_created_metrics(date_str):
     if not amo_enabled():
         return {
@@ -532,6 +692,330 @@ def amo_leads_created_metrics(date_str):
         "revenue": revenue
     }
 
+def amo_invalidate_lead_cache():
+    """Выкидывает из amo_lead_cache сделки, у которых с прошлой проверки сменился
+    ответственный или сумма сделки. Возвращает False, если события получить не удалось."""
+    now = int(time.time())
+    checked_at = get_setting("amo_lead_cache_checked_at")
+    conn = db_connection()
+    try:
+        if checked_at is None:
+            # Без отметки не знаем, что менялось, — начинаем кэш заново
+            conn.execute("DELETE FROM amo_lead_cache")
+            conn.commit()
+            set_setting("amo_lead_cache_checked_at", now)
+            return True
+        changed = set()
+        page = 1
+        while True:
+            params = [
+                ("limit", 250),
+                ("page", page),
+                ("filter[type][]", "entity_responsible_changed"),
+                ("filter[type][]", f"custom_field_{AMO_FIELD_DEAL_SUM}_value_changed"),
+                ("filter[created_at][from]", int(checked_at) - AMO_LEAD_CACHE_OVERLAP),
+                ("filter[created_at][to]", now),
+            ]
+            try:
+                r = amo_get("/api/v4/events", params=params)
+            except requests.RequestException as e:
+                print(f"AMO lead cache events request error: {e}")
+                return False
+            if r.status_code == 204:
+                break
+            if r.status_code != 200:
+                print(f"AMO lead cache events HTTP {r.status_code}: {r.text}")
+                return False
+            events = r.json().get("_embedded", {}).get("events", []) or []
+            for event in events:
+                if event.get("entity_type") in ("lead", "leads") and event.get("entity_id"):
+                    changed.add(int(event["entity_id"]))
+            if len(events) < 250:
+                break
+            page += 1
+        changed = list(changed)
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i+500]
+            conn.execute(
+                "DELETE FROM amo_lead_cache WHERE lead_id IN ({})".format(",".join(["?"] * len(chunk))),
+                chunk
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    set_setting("amo_lead_cache_checked_at", now)
+    return True
+
+def amo_lookup_leads(lead_ids):
+    """lead_id -> (responsible_user_id, сумма сделки).
+
+    Сначала читается amo_lead_cache (переживает дни и перезапуски), промахи
+    догружаются из /api/v4/leads и кладутся в кэш.
+    """
+    lead_ids = [int(lid) for lid in lead_ids]
+    found = {}
+    now = time.time()
+    cache_ok = bool(lead_ids) and amo_invalidate_lead_cache()
+    if cache_ok:
+        conn = db_connection()
+        try:
+            for i in range(0, len(lead_ids), 500):
+                chunk = lead_ids[i:i+500]
+                rows = conn.execute(
+                    "SELECT lead_id, responsible_user_id, deal_sum FROM amo_lead_cache WHERE fetched_at >= ? AND lead_id IN ({})".format(
+                        ",".join(["?"] * len(chunk))
+                    ),
+                    [now - AMO_LEAD_CACHE_TTL] + chunk
+                ).fetchall()
+                for row in rows:
+                    found[row["lead_id"]] = (row["responsible_user_id"], row["deal_sum"])
+        finally:
+            conn.close()
+    hits = len(found)
+    missing = [lid for lid in lead_ids if lid not in found]
+    fetched = []
+    chunk_size = 250
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i+chunk_size]
+        params = [("limit", 250)]
+        for lid in chunk:
+            params.append(("filter[id][]", str(lid)))
+        try:
+            r = amo_get("/api/v4/leads", params=params)
+        except requests.RequestException as e:
+            print(f"AMO leads request error: {e}")
+            continue
+        if r.status_code == 204:
+            continue
+        if r.status_code != 200:
+            print(f"AMO leads HTTP {r.status_code}: {r.text}")
+            continue
+        data = r.json()
+        leads = data.get("_embedded", {}).get("leads", []) or []
+        for lead in leads:
+            lead_id = lead.get("id")
+            rid = str(lead.get("responsible_user_id") or "")
+            if lead_id and rid:
+                amount = amo_field_numeric(lead, AMO_FIELD_DEAL_SUM)
+                found[int(lead_id)] = (rid, amount)
+                fetched.append((int(lead_id), rid, amount, lead.get("updated_at"), now))
+    if fetched and cache_ok:
+        conn = db_connection()
+        try:
+            conn.executemany(
+                """
+                INSERT INTO amo_lead_cache (lead_id, responsible_user_id, deal_sum, updated_at, fetched_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(lead_id) DO UPDATE SET
+                    responsible_user_id=excluded.responsible_user_id,
+                    deal_sum=excluded.deal_sum,
+                    updated_at=excluded.updated_at,
+                    fetched_at=excluded.fetched_at
+                """,
+                fetched
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    if lead_ids:
+        print(f"AMO lead cache: {hits} hits, {len(missing)} fetched")
+    return found
+
+def amo_extract_field_change(event):
+    value_after = event.get("value_after")
+    value_before = event.get("value_before")
+
+    if isinstance(value_after, list) and len(value_after) == 0 and value_before:
+        items = value_before if isinstance(value_before, list) else [value_before]
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if isinstance(item.get("custom_field_value"), dict):
+                cf = item["custom_field_value"]
+                field_id = cf.get("field_id") or cf.get("id")
+                if field_id is not None:
+                    return str(field_id), []
+            field_id = item.get("field_id") or item.get("id") or item.get("custom_field_id")
+            if field_id is not None:
+                return str(field_id), []
+    def extract_from_items(items, fallback_empty=False):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if isinstance(item.get("custom_field_value"), dict):
+                cf = item["custom_field_value"]
+                field_id = cf.get("field_id") or cf.get("id")
+                value = cf.get("value")
+                if value is None:
+                    value = cf.get("text")
+                if value is None:
+                    value = cf.get("enum_id")
+                values = [value] if value is not None else ([] if fallback_empty else None)
+                return (str(field_id) if field_id is not None else ""), values
+            field_id = item.get("field_id") or item.get("id") or item.get("custom_field_id")
+            if field_id is None:
+                field = item.get("field") or item.get("custom_field")
+                if isinstance(field, dict):
+                    field_id = field.get("id") or field.get("field_id")
+            if field_id is None:
+                field_id = event.get("field_id") or event.get("custom_field_id")
+            values = item.get("values")
+            if values is None and isinstance(item.get("value"), list):
+                values = item.get("value")
+            if values is None and "value" in item:
+                values = [item.get("value")]
+            return (str(field_id) if field_id is not None else ""), values
+        return "", None
+
+    items = []
+    if isinstance(value_after, list):
+        items = value_after
+    elif isinstance(value_after, dict):
+        items = [value_after]
+    field_id, values = extract_from_items(items)
+    if field_id:
+        return field_id, values
+
+    value_before = event.get("value_before")
+    items = []
+    if isinstance(value_before, list):
+        items = value_before
+    elif isinstance(value_before, dict):
+        items = [value_before]
+    field_id, values = extract_from_items(items, fallback_empty=True)
+    if field_id:
+        return field_id, values
+
+    field_id = event.get("field_id") or event.get("custom_field_id")
+    if field_id is not None:
+        return str(field_id), event.get("values") or event.get("value")
+    return "", None
+
+def amo_values_true(values):
+    if values is None:
+        return False
+    if not isinstance(values, list):
+        values = [values]
+    for v in values:
+        if isinstance(v, dict):
+            v = v.get("value")
+        if isinstance(v, str):
+            vv = v.strip().lower()
+            if vv in ("true", "1", "да", "yes", "y", "on", "вкл", "вкл."):
+                return True
+            if vv in ("false", "0", "нет", "no", "n", "off", "выкл", "выкл."):
+                return False
+        if v is True or v == 1:
+            return True
+    return False
+
+def amo_is_lead_event(event):
+    entity_type = event.get("entity_type")
+    if not entity_type:
+        entity_type = (event.get("_embedded", {}) or {}).get("entity", {}) or {}
+        entity_type = entity_type.get("type")
+    if isinstance(entity_type, str):
+        entity_type = entity_type.lower()
+    if entity_type and entity_type not in ("lead", "leads"):
+        return False
+    return True
+
+AMO_TRUE_VALUES = ("true", "1", "да", "yes", "y", "on", "вкл", "вкл.")
+AMO_FALSE_VALUES = ("false", "0", "нет", "no", "n", "off", "выкл", "выкл.")
+_SHAPE_MISMATCH = object()
+
+def amo_field_flag(event, field_id):
+    """Эталон: None, если событие не про field_id, иначе значение флага."""
+    event_field_id, values = amo_extract_field_change(event)
+    if event_field_id != field_id:
+        return None
+    return amo_values_true(values)
+
+class AmoFieldChangeDecoder:
+    """Быстрый разбор событий смены поля для одного field_id.
+
+    Для каждого типа события по первому экземпляру выбирается парсер под его
+    форму (значение в value_after или очистка через value_before) и
+    кэшируется. Парсер сначала сверяет field_id и только для нужного поля
+    разбирает значение. Если событие не совпало с формой — эталонный
+    amo_field_flag, результат тот же.
+    """
+
+    def __init__(self, field_id):
+        self.field_id = str(field_id)
+        self.parsers = {}
+
+    def is_lead(self, event):
+        entity_type = event.get("entity_type")
+        if entity_type and type(entity_type) is str:
+            return entity_type.lower() in ("lead", "leads")
+        return amo_is_lead_event(event)
+
+    def field_flag(self, event):
+        event_type = event.get("type")
+        parser = self.parsers.get(event_type)
+        if parser is None:
+            parser = self.parsers[event_type] = self._pick(event)
+        result = parser(event)
+        if result is _SHAPE_MISMATCH:
+            return amo_field_flag(event, self.field_id)
+        return result
+
+    def _pick(self, event):
+        for parser in (self._parse_value_after, self._parse_cleared):
+            if parser(event) is not _SHAPE_MISMATCH:
+                return parser
+        return self._parse_reference
+
+    def _parse_reference(self, event):
+        return amo_field_flag(event, self.field_id)
+
+    def _parse_value_after(self, event):
+        value_after = event.get("value_after")
+        if type(value_after) is not list or not value_after:
+            return _SHAPE_MISMATCH
+        item = value_after[0]
+        if type(item) is not dict:
+            return _SHAPE_MISMATCH
+        cf = item.get("custom_field_value")
+        if type(cf) is not dict:
+            return _SHAPE_MISMATCH
+        field_id = cf.get("field_id") or cf.get("id")
+        if field_id is None:
+            return _SHAPE_MISMATCH
+        if str(field_id) != self.field_id:
+            return None
+        value = cf.get("value")
+        if value is None:
+            value = cf.get("text")
+        if value is None:
+            value = cf.get("enum_id")
+        if value is None:
+            return False
+        if isinstance(value, dict):
+            value = value.get("value")
+        if isinstance(value, str):
+            value = value.strip().lower()
+            return value in AMO_TRUE_VALUES
+        return value is True or value == 1
+
+    def _parse_cleared(self, event):
+        value_after = event.get("value_after")
+        value_before = event.get("value_before")
+        if type(value_after) is not list or value_after or type(value_before) is not list or not value_before:
+            return _SHAPE_MISMATCH
+        item = value_before[0]
+        if type(item) is not dict:
+            return _SHAPE_MISMATCH
+        cf = item.get("custom_field_value")
+        if type(cf) is not dict:
+            return _SHAPE_MISMATCH
+        field_id = cf.get("field_id") or cf.get("id")
+        if field_id is None:
+            return _SHAPE_MISMATCH
+        # Поле очищено: эталон отдаёт пустой список значений, то есть False
+        return False if str(field_id) == self.field_id else None
+
 def amo_leads_event_metrics(date_str):
     if not amo_enabled():
         return {
@@ -547,106 +1031,7 @@ def amo_leads_event_metrics(date_str):
     page = 1
     total = 0
     debug_seen = 0
-    debug_seen = 0
-
-    def extract_field_change(event):
-        value_after = event.get("value_after")
-        value_before = event.get("value_before")
-
-        if isinstance(value_after, list) and len(value_after) == 0 and value_before:
-            items = value_before if isinstance(value_before, list) else [value_before]
-            for item in items:
-                if not isinstance(item, dict):
-                    continue
-                if isinstance(item.get("custom_field_value"), dict):
-                    cf = item["custom_field_value"]
-                    field_id = cf.get("field_id") or cf.get("id")
-                    if field_id is not None:
-                        return str(field_id), []
-                field_id = item.get("field_id") or item.get("id") or item.get("custom_field_id")
-                if field_id is not None:
-                    return str(field_id), []
-        def extract_from_items(items, fallback_empty=False):
-            for item in items:
-                if not isinstance(item, dict):
-                    continue
-                if isinstance(item.get("custom_field_value"), dict):
-                    cf = item["custom_field_value"]
-                    field_id = cf.get("field_id") or cf.get("id")
-                    value = cf.get("value")
-                    if value is None:
-                        value = cf.get("text")
-                    if value is None:
-                        value = cf.get("enum_id")
-                    values = [value] if value is not None else ([] if fallback_empty else None)
-                    return (str(field_id) if field_id is not None else ""), values
-                field_id = item.get("field_id") or item.get("id") or item.get("custom_field_id")
-                if field_id is None:
-                    field = item.get("field") or item.get("custom_field")
-                    if isinstance(field, dict):
-                        field_id = field.get("id") or field.get("field_id")
-                if field_id is None:
-                    field_id = event.get("field_id") or event.get("custom_field_id")
-                values = item.get("values")
-                if values is None and isinstance(item.get("value"), list):
-                    values = item.get("value")
-                if values is None and "value" in item:
-                    values = [item.get("value")]
-                return (str(field_id) if field_id is not None else ""), values
-            return "", None
-
-        items = []
-        if isinstance(value_after, list):
-            items = value_after
-        elif isinstance(value_after, dict):
-            items = [value_after]
-        field_id, values = extract_from_items(items)
-        if field_id:
-            return field_id, values
-
-        value_before = event.get("value_before")
-        items = []
-        if isinstance(value_before, list):
-            items = value_before
-        elif isinstance(value_before, dict):
-            items = [value_before]
-        field_id, values = extract_from_items(items, fallback_empty=True)
-        if field_id:
-            return field_id, values
-
-        field_id = event.get("field_id") or event.get("custom_field_id")
-        if field_id is not None:
-            return str(field_id), event.get("values") or event.get("value")
-        return "", None
-
-    def values_true(values):
-        if values is None:
-            return False
-        if not isinstance(values, list):
-            values = [values]
-        for v in values:
-            if isinstance(v, dict):
-                v = v.get("value")
-            if isinstance(v, str):
-                vv = v.strip().lower()
-                if vv in ("true", "1", "да", "yes", "y", "on", "вкл", "вкл."):
-                    return True
-                if vv in ("false", "0", "нет", "no", "n", "off", "выкл", "выкл."):
-                    return False
-            if v is True or v == 1:
-                return True
-        return False
-
-    def is_lead_event(event):
-        entity_type = event.get("entity_type")
-        if not entity_type:
-            entity_type = (event.get("_embedded", {}) or {}).get("entity", {}) or {}
-            entity_type = entity_type.get("type")
-        if isinstance(entity_type, str):
-            entity_type = entity_type.lower()
-        if entity_type and entity_type not in ("lead", "leads"):
-            return False
-        return True
+    decoder = AmoFieldChangeDecoder(AMO_FIELD_MEETING_OK)
 
     def fetch_events(types, handler):
         page = 1
@@ -679,7 +1064,7 @@ def amo_leads_event_metrics(date_str):
 
     def handle_status_event(event):
         nonlocal total
-        if not is_lead_event(event):
+        if not decoder.is_lead(event):
             return
         lead_id = event.get("entity_id")
         if not lead_id:
@@ -714,7 +1099,7 @@ def amo_leads_event_metrics(date_str):
 
     def handle_field_event(event):
         nonlocal total, debug_seen
-        if not is_lead_event(event):
+        if not decoder.is_lead(event):
             return
         lead_id = event.get("entity_id")
         if not lead_id:
@@ -724,14 +1109,14 @@ def amo_leads_event_metrics(date_str):
         created_by = str(event.get("created_by") or "")
         if created_by:
             created_by_map[lead_id] = created_by
-        field_id, values = extract_field_change(event)
         if AMO_DEBUG_EVENTS and debug_seen < 20:
+            field_id, values = amo_extract_field_change(event)
             print(f"AMO field change lead={lead_id} field_id={field_id} values={values}")
             debug_seen += 1
-        if field_id == AMO_FIELD_MEETING_OK:
-            flag = values_true(values)
+        flag = decoder.field_flag(event)
+        if flag is not None:
             if AMO_DEBUG_EVENTS:
-                print(f"AMO meeting_ok lead={lead_id} at={event_ts} values={values} flag={flag}")
+                print(f"AMO meeting_ok lead={lead_id} at={event_ts} flag={flag}")
             prev = agreement_latest.get(lead_id)
             if not prev or event_ts >= prev[0]:
                 agreement_latest[lead_id] = (event_ts, flag)
@@ -744,30 +1129,10 @@ def amo_leads_event_metrics(date_str):
 
     lead_map = {}
     lead_amounts = {}
-    chunk_size = 250
-    for i in range(0, len(lead_ids), chunk_size):
-        chunk = lead_ids[i:i+chunk_size]
-        params = [("limit", 250)]
-        for lid in chunk:
-            params.append(("filter[id][]", str(lid)))
-        try:
-            r = amo_get("/api/v4/leads", params=params)
-        except requests.RequestException as e:
-            print(f"AMO leads request error: {e}")
-            continue
-        if r.status_code == 204:
-            continue
-        if r.status_code != 200:
-            print(f"AMO leads HTTP {r.status_code}: {r.text}")
-            continue
-        data = r.json()
-        leads = data.get("_embedded", {}).get("leads", []) or []
-        for lead in leads:
-            lead_id = lead.get("id")
-            rid = str(lead.get("responsible_user_id") or "")
-            if lead_id and rid:
-                lead_map[lead_id] = rid
-                lead_amounts[lead_id] = amo_field_numeric(lead, AMO_FIELD_DEAL_SUM)
+    found = amo_lookup_leads(lead_ids)
+    for lead_id in lead_ids:
+        if int(lead_id) in found:
+            lead_map[lead_id], lead_amounts[lead_id] = found[int(lead_id)]
 
     agreement = Counter()
     meeting = Counter()
@@ -942,7 +1307,7 @@ def fetch_ck_sheet():
         print("CK sheet disabled: CK_SHEET_CSV_URL is empty")
         return None
     try:
-        r = requests.get(CK_SHEET_CSV_URL, timeout=REQUEST_TIMEOUT)
+        r = metrics.observe("ck_sheet", "/csv", lambda: requests.get(CK_SHEET_CSV_URL, timeout=REQUEST_TIMEOUT))
     except requests.RequestException as e:
         print(f"CK sheet error: {str(e)}")
         return None
@@ -1040,6 +1405,7 @@ def sync_ck_sheet_all():
                         """,
                         (date_str, oid, OPERATORS.get(oid, oid), 0, 0, 0, 0, 0, 0, 0, count, 0, 0, now)
                     )
+            refresh_sync_state(conn, date_str, ck_status="ok")
         conn.commit()
     finally:
         conn.close()
@@ -1085,6 +1451,136 @@ def init_db():
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                caller TEXT,
+                status TEXT NOT NULL,
+                total_ms INTEGER NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                operators INTEGER NOT NULL DEFAULT 0,
+                calls INTEGER NOT NULL DEFAULT 0,
+                phases TEXT NOT NULL,
+                error TEXT
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                date TEXT PRIMARY KEY,
+                day_key INTEGER NOT NULL,
+                synced_at TEXT,
+                fetched_at TEXT,
+                operators INTEGER NOT NULL DEFAULT 0,
+                calls INTEGER NOT NULL DEFAULT 0,
+                amo_status TEXT,
+                ck_status TEXT,
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_state_day_key ON sync_state(day_key)")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfill_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                start TEXT,
+                end TEXT,
+                dates TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                failed TEXT NOT NULL DEFAULT '[]',
+                current TEXT,
+                created_at TEXT NOT NULL,
+                finished_at TEXT,
+                heartbeat REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfill_dates (
+                date TEXT PRIMARY KEY,
+                job_id TEXT,
+                failed_at REAL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS calls (
+                day_key INTEGER NOT NULL,
+                operator_id TEXT NOT NULL,
+                call_id TEXT NOT NULL,
+                status_id TEXT NOT NULL,
+                talk_duration INTEGER NOT NULL,
+                started_at TEXT,
+                PRIMARY KEY (day_key, operator_id, call_id)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS hourly_operator_stats (
+                day_key INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                operator_id TEXT NOT NULL,
+                all_calls INTEGER NOT NULL,
+                total_calls INTEGER NOT NULL,
+                cs8_calls INTEGER NOT NULL,
+                cs20_calls INTEGER NOT NULL,
+                cs22_calls INTEGER NOT NULL,
+                lead_agent_calls INTEGER NOT NULL,
+                talk_sum INTEGER NOT NULL,
+                talk_count INTEGER NOT NULL,
+                PRIMARY KEY (day_key, operator_id, hour)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS amo_lead_cache (
+                lead_id INTEGER PRIMARY KEY,
+                responsible_user_id TEXT NOT NULL,
+                deal_sum INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS amo_day_tiles (
+                day_key INTEGER PRIMARY KEY,
+                date TEXT NOT NULL,
+                final INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS amo_tile_calls (
+                day_key INTEGER NOT NULL,
+                operator_id TEXT NOT NULL,
+                calls_1m INTEGER NOT NULL,
+                PRIMARY KEY (day_key, operator_id)
+            ) WITHOUT ROWID
+            """
+        )
         cols = [row[1] for row in conn.execute("PRAGMA table_info(daily_operator_stats)")]
         if "lead_agent_calls" not in cols:
             conn.execute("ALTER TABLE daily_operator_stats ADD COLUMN lead_agent_calls INTEGER NOT NULL DEFAULT 0")
@@ -1102,13 +1598,89 @@ def init_db():
             conn.execute("ALTER TABLE daily_operator_stats ADD COLUMN amo_deals INTEGER NOT NULL DEFAULT 0")
         if "amo_revenue" not in cols:
             conn.execute("ALTER TABLE daily_operator_stats ADD COLUMN amo_revenue INTEGER NOT NULL DEFAULT 0")
+        state_cols = [row[1] for row in conn.execute("PRAGMA table_info(sync_state)")]
+        if "fetched_at" not in state_cols:
+            conn.execute("ALTER TABLE sync_state ADD COLUMN fetched_at TEXT")
+            # Дни, выгруженные до своего окончания, больше не считаются окончательно синкнутыми
+            conn.execute(
+                f"""
+                UPDATE sync_state SET
+                    fetched_at = synced_at,
+                    synced_at = CASE WHEN synced_at < {SYNC_DAY_END_SQL} THEN NULL ELSE synced_at END
+                """
+            )
+        if conn.execute("SELECT 1 FROM sync_state LIMIT 1").fetchone() is None:
+            rebuild_sync_state(conn)
         conn.commit()
     finally:
         conn.close()
 
+# Начало следующего дня по колонке date (ДД-ММ-ГГГГ) в формате отметок времени
+SYNC_DAY_END_SQL = "date(substr(date,7,4)||'-'||substr(date,4,2)||'-'||substr(date,1,2), '+1 day')"
+
+def rebuild_sync_state(conn):
+    """Заполняет sync_state по уже сохранённой daily_operator_stats (для старых баз)."""
+    conn.execute("DELETE FROM sync_state")
+    conn.execute(
+        f"""
+        INSERT INTO sync_state (date, day_key, synced_at, fetched_at, operators, calls, updated_at)
+        SELECT
+            date,
+            CAST(substr(date,7,4)||substr(date,4,2)||substr(date,1,2) AS INTEGER),
+            CASE WHEN MAX(updated_at) < {SYNC_DAY_END_SQL} THEN NULL ELSE MAX(updated_at) END,
+            MAX(updated_at),
+            COUNT(*),
+            SUM(all_calls),
+            MAX(updated_at)
+        FROM daily_operator_stats
+        GROUP BY date
+        """
+    )
+
+def refresh_sync_state(conn, date_str, synced=False, amo_status=None, ck_status=None):
+    """Пересчитывает строку sync_state за день в той же транзакции, что и запись статистики.
+
+    synced=True значит, что звонки дня выгружены: ставится fetched_at. synced_at
+    ставится, только если день к этому моменту закончился, — выгрузка
+    сегодняшнего или будущего дня не окончательная, и день догрузят позже.
+    """
+    samara_now = datetime.now(pytz.timezone("Europe/Samara"))
+    now = samara_now.strftime("%Y-%m-%d %H:%M:%S")
+    final = synced and parse_date(date_str) < samara_now.date()
+    row = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(all_calls), 0) FROM daily_operator_stats WHERE date = ?",
+        (date_str,)
+    ).fetchone()
+    conn.execute(
+        """
+        INSERT INTO sync_state (date, day_key, synced_at, fetched_at, operators, calls, amo_status, ck_status, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(date) DO UPDATE SET
+            synced_at=COALESCE(excluded.synced_at, sync_state.synced_at),
+            fetched_at=COALESCE(excluded.fetched_at, sync_state.fetched_at),
+            operators=excluded.operators,
+            calls=excluded.calls,
+            amo_status=COALESCE(excluded.amo_status, sync_state.amo_status),
+            ck_status=COALESCE(excluded.ck_status, sync_state.ck_status),
+            updated_at=excluded.updated_at
+        """,
+        (
+            date_str, int(to_db_key(date_str)), now if final else None, now if synced else None,
+            row[0], row[1], amo_status, ck_status, now
+        )
+    )
+
+def get_sync_state(date_str):
+    conn = db_connection()
+    try:
+        return conn.execute("SELECT * FROM sync_state WHERE date = ?", (date_str,)).fetchone()
+    finally:
+        conn.close()
+
 def db_connection():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    conn.set_trace_callback(slowlog.record_query)
     return conn
 
 def fetch_existing_amo_ids(date_str):
@@ -1161,33 +1733,41 @@ def format_date(d):
 def list_saved_dates():
     conn = db_connection()
     try:
-        rows = conn.execute("SELECT DISTINCT date FROM daily_operator_stats ORDER BY date").fetchall()
+        rows = conn.execute("SELECT date FROM sync_state WHERE fetched_at IS NOT NULL ORDER BY day_key").fetchall()
         return [row["date"] for row in rows]
     finally:
         conn.close()
 
-def ensure_range_synced(start_date, end_date):
+def find_missing_dates(start_date, end_date):
     if not start_date or not end_date:
         return []
     start = parse_date(start_date)
     end = parse_date(end_date)
     if start > end:
         start, end = end, start
-    available = set(list_saved_dates())
+    conn = db_connection()
+    try:
+        rows = conn.execute(
+            "SELECT date, synced_at, fetched_at FROM sync_state WHERE day_key BETWEEN ? AND ?",
+            (int(start.strftime("%Y%m%d")), int(end.strftime("%Y%m%d")))
+        ).fetchall()
+    finally:
+        conn.close()
+    today = datetime.now(pytz.timezone("Europe/Samara")).date()
+    # Прошедший день недостающий, пока его не выгрузили после окончания (synced_at пуст);
+    # сегодняшнему достаточно одной успешной выгрузки, будущие дни не запрашиваем
+    available = {
+        row["date"] for row in rows
+        if row["synced_at"] or (row["fetched_at"] and parse_date(row["date"]) >= today)
+    }
     missing = []
     d = start
+    end = min(end, today)
     while d <= end:
         ds = format_date(d)
         if ds not in available:
             missing.append(ds)
         d += timedelta(days=1)
-    if not missing:
-        return []
-    for ds in missing:
-        try:
-            sync_day(ds)
-        except Exception as e:
-            print(f"Auto sync failed for {ds}: {e}")
     return missing
 
 def get_ck_lead_counts_from_db(date_str):
@@ -1228,6 +1808,7 @@ def update_ck_lead_from_sheet(date_str, operators_map):
                     """,
                     (date_str, oid, operators_map.get(oid, oid), 0, 0, 0, 0, 0, 0, 0, count, 0, 0, now)
                 )
+        refresh_sync_state(conn, date_str, ck_status="ok")
         conn.commit()
     finally:
         conn.close()
@@ -1236,7 +1817,7 @@ def has_date_in_db(date_str):
     conn = db_connection()
     try:
         row = conn.execute(
-            "SELECT 1 FROM daily_operator_stats WHERE date = ? LIMIT 1",
+            "SELECT 1 FROM sync_state WHERE date = ? AND fetched_at IS NOT NULL",
             (date_str,)
         ).fetchone()
         return row is not None
@@ -1247,7 +1828,7 @@ def has_call_data_for_date(date_str):
     conn = db_connection()
     try:
         row = conn.execute(
-            "SELECT 1 FROM daily_operator_stats WHERE date = ? AND all_calls > 0 LIMIT 1",
+            "SELECT 1 FROM sync_state WHERE date = ? AND calls > 0",
             (date_str,)
         ).fetchone()
         return row is not None
@@ -1337,20 +1918,8 @@ def to_db_key(date_str):
 def get_db_range():
     conn = db_connection()
     try:
-        row = conn.execute(
-            """
-            SELECT date FROM daily_operator_stats
-            ORDER BY (substr(date,7,4)||substr(date,4,2)||substr(date,1,2)) ASC
-            LIMIT 1
-            """
-        ).fetchone()
-        row_max = conn.execute(
-            """
-            SELECT date FROM daily_operator_stats
-            ORDER BY (substr(date,7,4)||substr(date,4,2)||substr(date,1,2)) DESC
-            LIMIT 1
-            """
-        ).fetchone()
+        row = conn.execute("SELECT date FROM sync_state ORDER BY day_key ASC LIMIT 1").fetchone()
+        row_max = conn.execute("SELECT date FROM sync_state ORDER BY day_key DESC LIMIT 1").fetchone()
         return (row["date"] if row else None, row_max["date"] if row_max else None)
     finally:
         conn.close()
@@ -1463,6 +2032,89 @@ def get_report_data(start_date=None, end_date=None):
         }
     }
 
+HOURLY_METRICS = ("all", "total", "cs8", "cs20", "cs22", "lead_agent", "talk_sum", "talk_count")
+
+def get_hourly_report(start_date=None, end_date=None, operator_ids=None):
+    if not start_date or not end_date:
+        _, db_end = get_db_range()
+        if not db_end:
+            return {"range": None, "hours": list(range(24)), "operators": [], "totals": {}}
+        start_date = start_date or end_date or db_end
+        end_date = end_date or start_date
+    if parse_date(start_date) > parse_date(end_date):
+        start_date, end_date = end_date, start_date
+    params = [int(to_db_key(start_date)), int(to_db_key(end_date))]
+    operator_filter = ""
+    if operator_ids:
+        operator_filter = "AND operator_id IN ({})".format(",".join(["?"] * len(operator_ids)))
+        params += list(operator_ids)
+    conn = db_connection()
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT
+                operator_id,
+                hour,
+                SUM(all_calls) AS all_calls,
+                SUM(total_calls) AS total_calls,
+                SUM(cs8_calls) AS cs8_calls,
+                SUM(cs20_calls) AS cs20_calls,
+                SUM(cs22_calls) AS cs22_calls,
+                SUM(lead_agent_calls) AS lead_agent_calls,
+                SUM(talk_sum) AS talk_sum,
+                SUM(talk_count) AS talk_count
+            FROM hourly_operator_stats
+            WHERE day_key BETWEEN ? AND ? {operator_filter}
+            GROUP BY operator_id, hour
+            """,
+            params
+        ).fetchall()
+        ids = sorted({row["operator_id"] for row in rows} - EXCLUDED_OPERATOR_IDS)
+        names = {}
+        if ids:
+            # Имена берём только из дней отчёта: дни находятся по индексу sync_state, строки — по ключу (date, operator_id)
+            for row in conn.execute(
+                """
+                SELECT operator_id, operator_name
+                FROM daily_operator_stats
+                WHERE date IN (SELECT date FROM sync_state WHERE day_key BETWEEN ? AND ?)
+                  AND operator_id IN ({})
+                ORDER BY updated_at
+                """.format(",".join(["?"] * len(ids))),
+                params[:2] + ids
+            ):
+                names[row["operator_id"]] = row["operator_name"]
+    finally:
+        conn.close()
+
+    columns = dict(zip(HOURLY_METRICS, (
+        "all_calls", "total_calls", "cs8_calls", "cs20_calls", "cs22_calls", "lead_agent_calls", "talk_sum", "talk_count"
+    )))
+    series = {oid: {metric: [0] * 24 for metric in HOURLY_METRICS} for oid in ids}
+    totals = {metric: [0] * 24 for metric in HOURLY_METRICS}
+    for row in rows:
+        data = series.get(row["operator_id"])
+        if data is None:
+            continue
+        hour = row["hour"]
+        for metric, column in columns.items():
+            value = row[column] or 0
+            data[metric][hour] = value
+            totals[metric][hour] += value
+    operators = []
+    for oid in ids:
+        data = series[oid]
+        data["avg"] = [s // c if c else 0 for s, c in zip(data["talk_sum"], data["talk_count"])]
+        operators.append({"operator_id": oid, "operator_name": names.get(oid, OPERATORS.get(oid, oid)), **data})
+    operators.sort(key=lambda item: item["operator_name"])
+    totals["avg"] = [s // c if c else 0 for s, c in zip(totals["talk_sum"], totals["talk_count"])]
+    return {
+        "range": {"start": start_date, "end": end_date},
+        "hours": list(range(24)),
+        "operators": operators,
+        "totals": totals
+    }
+
 def get_moscow_report_data_db(start_date=None, end_date=None):
     db_start, db_end = get_db_range()
     if not db_start or not db_end:
@@ -1669,43 +2321,82 @@ def recalc_report_totals(rows):
         "avg": avg_total,
         "reach": reach
     }
-def fetch_calls_for_date(date_str, operators_map=None):
+def iter_call_pages(date_str, operators_map=None, limit=1000, statuses=None):
     params_base = build_base_params(requested_date=date_str, operators_map=operators_map)
+    for s in statuses or []:
+        params_base.append(("client_statuses[]", s))
     page = 1
-    limit = 1000
-    items = []
     while True:
         params = params_base + [("page", page), ("limit", limit)]
-        r = requests.get(CALL_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        r = sip_get(CALL_LIST_URL, params=params)
         r.raise_for_status()
         chunk = r.json().get("items", [])
         if not chunk:
             break
-        items.extend(chunk)
+        yield chunk
         if len(chunk) < limit:
             break
         page += 1
+
+def fetch_calls_for_date(date_str, operators_map=None):
+    items = []
+    for chunk in iter_call_pages(date_str, operators_map=operators_map):
+        items.extend(chunk)
     return items
 
+def new_call_stats():
+    return StatsTable()
+
 def aggregate_calls(calls, operators_map=None):
-    stats = defaultdict(lambda: {
-        "all": 0,
-        "total": 0,
-        "cs8": 0,
-        "cs20": 0,
-        "cs22": 0,
-        "lead_agent": 0,
-        "line": 0,
-        "ck_lead": 0,
-        "amo_calls_1m": 0,
-        "amo_agreements": 0,
-        "amo_meetings": 0,
-        "amo_deals": 0,
-        "amo_revenue": 0,
-        "talk_sum": 0,
-        "talk_count": 0,
-        "name": ""
-    })
+    stats = new_call_stats()
+    add_calls_to_stats(stats, calls, operators_map)
+    return stats
+
+def aggregate_call_pages(pages, operators_map=None, raw=None, hourly=None):
+    """Агрегирует звонки постранично, не держа в памяти весь день.
+
+    Возвращает (stats, operators_from_calls, calls_count). Если operators_map
+    пуст, фильтр и имена берутся из операторов, найденных в самих звонках, —
+    как aggregate_calls(calls, extract_operators_from_calls(calls)).
+    В raw (если передан список) складываются компактные строки учтённых звонков
+    для таблицы calls, в hourly (StatsTable) — счётчики по (оператор, час).
+    """
+    stats = new_call_stats()
+    found = {}
+    count = 0
+    for chunk in pages:
+        found.update(extract_operators_from_calls(chunk))
+        add_calls_to_stats(stats, chunk, operators_map, raw=raw, hourly=hourly)
+        count += len(chunk)
+    if not operators_map and found:
+        for oid in list(stats):
+            if oid in found:
+                stats[oid].name = found[oid]
+            else:
+                del stats[oid]
+        if raw:
+            raw[:] = [row for row in raw if row[1] in found]
+        if hourly:
+            for key in [key for key in hourly if key[0] not in found]:
+                del hourly[key]
+    return stats, found, count
+
+def count_call(rec, status, td):
+    rec.all += 1
+    if status in STAT_FULL and td > 20:
+        rec.total += 1
+        rec.talk_sum += td
+        rec.talk_count += 1
+    if status in CS8:
+        rec.cs8 += 1
+    if status in CS20:
+        rec.cs20 += 1
+    if status in CS22:
+        rec.cs22 += 1
+    if status in LEAD_AGENT:
+        rec.lead_agent += 1
+
+def add_calls_to_stats(stats, calls, operators_map=None, raw=None, hourly=None):
     for call in calls:
         op = call.get("operator") or {}
         oid = str(op.get("id") or "")
@@ -1716,139 +2407,298 @@ def aggregate_calls(calls, operators_map=None):
         name = op.get("full_name") or op.get("fullName") or operators_map.get(oid, "") if operators_map else ""
         status = get_status_id(call)
         td = get_talk_duration(call)
-        is_dialog = status in STAT_FULL and td > 20
-        stats[oid]["all"] += 1
-        if is_dialog:
-            stats[oid]["total"] += 1
-            stats[oid]["talk_sum"] += td
-            stats[oid]["talk_count"] += 1
-        if status in CS8:
-            stats[oid]["cs8"] += 1
-        if status in CS20:
-            stats[oid]["cs20"] += 1
-        if status in CS22:
-            stats[oid]["cs22"] += 1
-        if status in LEAD_AGENT:
-            stats[oid]["lead_agent"] += 1
+        rec = stats[oid]
+        count_call(rec, status, td)
         if name:
-            stats[oid]["name"] = name
-    return stats
+            rec.name = name
+        if raw is None and hourly is None:
+            continue
+        started_at = get_call_time(call)
+        if raw is not None:
+            call_id = call.get("id")
+            raw.append((str(call_id) if call_id else f"#{len(raw)}", oid, status, td, started_at))
+        if hourly is not None:
+            hour = get_call_hour(started_at)
+            if hour is not None:
+                count_call(hourly[(oid, hour)], status, td)
+
+def upsert_daily_stats(date_str, stats, amo_status=None, ck_status=None, raw_calls=None, hourly=None, synced=True):
+    now = datetime.now(pytz.timezone("Europe/Samara")).strftime("%Y-%m-%d %H:%M:%S")
+    conn = db_connection()
+    try:
+        conn.executemany(
+            """
+            INSERT INTO daily_operator_stats
+            (date, operator_id, operator_name, all_calls, total_calls, cs8_calls, cs20_calls, cs22_calls, lead_agent_calls, line_calls, ck_lead_calls, amo_calls_1m, amo_agreements, amo_meetings, amo_deals, amo_revenue, talk_sum, talk_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(date, operator_id) DO UPDATE SET
+                operator_name=excluded.operator_name,
+                all_calls=excluded.all_calls,
+                total_calls=excluded.total_calls,
+                cs8_calls=excluded.cs8_calls,
+                cs20_calls=excluded.cs20_calls,
+                cs22_calls=excluded.cs22_calls,
+                lead_agent_calls=excluded.lead_agent_calls,
+                line_calls=excluded.line_calls,
+                ck_lead_calls=excluded.ck_lead_calls,
+                amo_calls_1m=excluded.amo_calls_1m,
+                amo_agreements=excluded.amo_agreements,
+                amo_meetings=excluded.amo_meetings,
+                amo_deals=excluded.amo_deals,
+                amo_revenue=excluded.amo_revenue,
+                talk_sum=excluded.talk_sum,
+                talk_count=excluded.talk_count,
+                updated_at=excluded.updated_at
+            """,
+            stats.db_rows(date_str, now)
+        )
+        if raw_calls is not None:
+            replace_raw_calls(conn, date_str, raw_calls)
+        if hourly is not None:
+            replace_hourly_stats(conn, date_str, hourly)
+        refresh_sync_state(conn, date_str, synced=synced, amo_status=amo_status, ck_status=ck_status)
+        conn.commit()
+    finally:
+        conn.close()
+
+def replace_raw_calls(conn, date_str, raw_calls):
+    day_key = int(to_db_key(date_str))
+    conn.execute("DELETE FROM calls WHERE day_key = ?", (day_key,))
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO calls (day_key, operator_id, call_id, status_id, talk_duration, started_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        ((day_key, oid, call_id, status, td, started_at) for call_id, oid, status, td, started_at in raw_calls)
+    )
 
-def upsert_daily_stats(date_str, stats):
+def replace_hourly_stats(conn, date_str, hourly):
+    day_key = int(to_db_key(date_str))
+    conn.execute("DELETE FROM hourly_operator_stats WHERE day_key = ?", (day_key,))
+    conn.executemany(
+        """
+        INSERT INTO hourly_operator_stats
+        (day_key, hour, operator_id, all_calls, total_calls, cs8_calls, cs20_calls, cs22_calls, lead_agent_calls, talk_sum, talk_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (day_key, hour, oid, rec.all, rec.total, rec.cs8, rec.cs20, rec.cs22, rec.lead_agent, rec.talk_sum, rec.talk_count)
+            for (oid, hour), rec in hourly.items()
+        )
+    )
+
+def recompute_day_from_calls(conn, date_str):
+    """Пересчитывает звонковые метрики дня из таблицы calls без обращения к SipSpeak.
+
+    Заодно пересобирается почасовая таблица. Колонки линии, ЦК и amoCRM не трогаются. Возвращает число звонков или None,
+    если сырых звонков за день нет.
+    """
+    day_key = int(to_db_key(date_str))
+    stats = new_call_stats()
+    hourly = StatsTable()
+    count = 0
+    for oid, status, td, started_at in conn.execute(
+        "SELECT operator_id, status_id, talk_duration, started_at FROM calls WHERE day_key = ?",
+        (day_key,)
+    ):
+        count_call(stats[oid], status, td)
+        hour = get_call_hour(started_at)
+        if hour is not None:
+            count_call(hourly[(oid, hour)], status, td)
+        count += 1
+    if not count:
+        return None
+    stats.drop(EXCLUDED_OPERATOR_IDS)
     now = datetime.now(pytz.timezone("Europe/Samara")).strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute(
+        """
+        UPDATE daily_operator_stats
+        SET all_calls = 0, total_calls = 0, cs8_calls = 0, cs20_calls = 0, cs22_calls = 0,
+            lead_agent_calls = 0, talk_sum = 0, talk_count = 0
+        WHERE date = ?
+        """,
+        (date_str,)
+    )
+    missing = StatsTable()
+    for oid, rec in stats.items():
+        values = (rec.all, rec.total, rec.cs8, rec.cs20, rec.cs22, rec.lead_agent, rec.talk_sum, rec.talk_count, now)
+        updated = conn.execute(
+            """
+            UPDATE daily_operator_stats
+            SET all_calls = ?, total_calls = ?, cs8_calls = ?, cs20_calls = ?, cs22_calls = ?,
+                lead_agent_calls = ?, talk_sum = ?, talk_count = ?, updated_at = ?
+            WHERE date = ? AND operator_id = ?
+            """,
+            values + (date_str, oid)
+        ).rowcount
+        if not updated:
+            rec.name = OPERATORS.get(oid, "")
+            missing[oid] = rec
+    if missing:
+        conn.executemany(
+            """
+            INSERT INTO daily_operator_stats
+            (date, operator_id, operator_name, all_calls, total_calls, cs8_calls, cs20_calls, cs22_calls, lead_agent_calls, line_calls, ck_lead_calls, amo_calls_1m, amo_agreements, amo_meetings, amo_deals, amo_revenue, talk_sum, talk_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            missing.db_rows(date_str, now)
+        )
+    if amo_enabled():
+        # То же правило, что в run_sync_day: согласия этих операторов берутся из cs8 SipSpeak
+        agreement_ids = [oid for oid in MOSCOW_SIPSPEAK_AGREEMENTS_IDS if oid in stats]
+        conn.executemany(
+            "UPDATE daily_operator_stats SET amo_agreements = cs8_calls WHERE date = ? AND operator_id = ?",
+            [(date_str, oid) for oid in agreement_ids]
+        )
+    replace_hourly_stats(conn, date_str, hourly)
+    refresh_sync_state(conn, date_str)
+    return count
+
+def recompute_range(start_str, end_str):
+    start = parse_date(start_str)
+    end = parse_date(end_str)
+    if start > end:
+        start, end = end, start
     conn = db_connection()
     try:
-        for oid, data in stats.items():
-            name = data["name"] or oid
-            conn.execute(
-                """
-                INSERT INTO daily_operator_stats
-                (date, operator_id, operator_name, all_calls, total_calls, cs8_calls, cs20_calls, cs22_calls, lead_agent_calls, line_calls, ck_lead_calls, amo_calls_1m, amo_agreements, amo_meetings, amo_deals, amo_revenue, talk_sum, talk_count, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(date, operator_id) DO UPDATE SET
-                    operator_name=excluded.operator_name,
-                    all_calls=excluded.all_calls,
-                    total_calls=excluded.total_calls,
-                    cs8_calls=excluded.cs8_calls,
-                    cs20_calls=excluded.cs20_calls,
-                    cs22_calls=excluded.cs22_calls,
-                    lead_agent_calls=excluded.lead_agent_calls,
-                    line_calls=excluded.line_calls,
-                    ck_lead_calls=excluded.ck_lead_calls,
-                    amo_calls_1m=excluded.amo_calls_1m,
-                    amo_agreements=excluded.amo_agreements,
-                    amo_meetings=excluded.amo_meetings,
-                    amo_deals=excluded.amo_deals,
-                    amo_revenue=excluded.amo_revenue,
-                    talk_sum=excluded.talk_sum,
-                    talk_count=excluded.talk_count,
-                    updated_at=excluded.updated_at
-                """,
-                (
-                    date_str,
-                    oid,
-                    name,
-                    data["all"],
-                    data["total"],
-                    data["cs8"],
-                    data["cs20"],
-                    data["cs22"],
-                    data["lead_agent"],
-                    data["line"],
-                    data["ck_lead"],
-                    data.get("amo_calls_1m", 0),
-                    data.get("amo_agreements", 0),
-                    data.get("amo_meetings", 0),
-                    data.get("amo_deals", 0),
-                    data.get("amo_revenue", 0),
-                    data["talk_sum"],
-                    data["talk_count"],
-                    now
-                )
+        dates = [
+            row["date"] for row in conn.execute(
+                "SELECT date FROM sync_state WHERE day_key BETWEEN ? AND ? ORDER BY day_key",
+                (int(start.strftime("%Y%m%d")), int(end.strftime("%Y%m%d")))
             )
+        ]
+        recomputed = {}
+        no_raw = []
+        for ds in dates:
+            count = recompute_day_from_calls(conn, ds)
+            if count is None:
+                no_raw.append(ds)
+            else:
+                recomputed[ds] = count
         conn.commit()
     finally:
         conn.close()
+    return {"recomputed": recomputed, "no_raw_calls": no_raw}
+
+class SyncRun:
+    def __init__(self, date_str):
+        self.date_str = date_str
+        self.caller = metrics.get_caller()
+        self.started_at = datetime.now(pytz.timezone("Europe/Samara")).strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        entry = {"name": name, "ms": 0, "requests": 0, "rows": 0}
+        started = time.perf_counter()
+        with metrics.capture() as calls:
+            try:
+                yield entry
+            finally:
+                entry["ms"] = int((time.perf_counter() - started) * 1000)
+                entry["requests"] = len(calls)
+                self.phases.append(entry)
+
+    def save(self, status, operators=0, calls=0, error=None):
+        total_ms = int((time.perf_counter() - self.started) * 1000)
+        try:
+            conn = db_connection()
+            try:
+                conn.execute(
+                    """
+                    INSERT INTO sync_runs
+                    (date, started_at, caller, status, total_ms, requests, operators, calls, phases, error)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        self.date_str, self.started_at, self.caller, status, total_ms,
+                        sum(p["requests"] for p in self.phases), operators, calls,
+                        json.dumps(self.phases), error
+                    )
+                )
+                conn.execute(
+                    "DELETE FROM sync_runs WHERE id <= (SELECT MAX(id) FROM sync_runs) - ?",
+                    (SYNC_RUNS_KEEP,)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Sync run log failed for {self.date_str}: {e}")
 
 def sync_day(date_str):
+    run = SyncRun(date_str)
     try:
-        fetch_operators()
-    except Exception as e:
-        print(f"SipSpeak operators fetch failed: {e}")
-    try:
-        calls = fetch_calls_for_date(date_str, operators_map=OPERATORS)
-    except Exception as e:
-        print(f"SipSpeak calls fetch failed for {date_str}: {e}")
-        calls = []
-    operators_from_calls = extract_operators_from_calls(calls)
-    operators_map = OPERATORS or operators_from_calls
-    try:
-        line_seconds = fetch_line_seconds(date_str, operators_map=operators_map)
-    except Exception as e:
-        print(f"SipSpeak line fetch failed for {date_str}: {e}")
-        line_seconds = {}
-    try:
-        ck_counts = ck_counts_from_sheet(date_str, operators_map)
+        result = run_sync_day(date_str, run)
     except Exception as e:
-        print(f"CK sheet fetch failed for {date_str}: {e}")
-        ck_counts = {}
-    stats = aggregate_calls(calls, operators_map=operators_map)
-    if ck_counts is None:
-        ck_counts = {}
-    for oid, count in ck_counts.items():
-        if oid not in stats:
-            stats[oid] = {
-                "all": 0,
-                "total": 0,
-                "cs8": 0,
-                "cs20": 0,
-                "cs22": 0,
-                "lead_agent": 0,
-                "line": 0,
-                "ck_lead": count,
-                "amo_calls_1m": 0,
-                "amo_agreements": 0,
-                "amo_meetings": 0,
-                "amo_deals": 0,
-                "amo_revenue": 0,
-                "talk_sum": 0,
-                "talk_count": 0,
-                "name": operators_map.get(oid, "")
-            }
-        else:
-            stats[oid]["ck_lead"] = count
-    for oid, seconds in line_seconds.items():
-        stats[oid]["line"] = seconds
-        if not stats[oid].get("name"):
-            stats[oid]["name"] = operators_map.get(oid, "")
+        run.save("error", error=str(e))
+        raise
+    run.save("ok", operators=result["operators"], calls=result["calls"])
+    return result
 
+def run_sync_day(date_str, run):
+    with run.phase("operators") as ph:
+        try:
+            fetch_operators()
+        except Exception as e:
+            print(f"SipSpeak operators fetch failed: {e}")
+        ph["rows"] = len(OPERATORS)
+    with run.phase("calls") as ph:
+        # Страницы агрегируются по мере получения, весь день в памяти не держим
+        raw_calls = []
+        hourly = StatsTable()
+        try:
+            stats, operators_from_calls, calls_count = aggregate_call_pages(
+                iter_call_pages(date_str, operators_map=OPERATORS), operators_map=OPERATORS,
+                raw=raw_calls, hourly=hourly
+            )
+        except Exception as e:
+            print(f"SipSpeak calls fetch failed for {date_str}: {e}")
+            stats, operators_from_calls, calls_count = new_call_stats(), {}, 0
+            # Сырые звонки прошлого синка не затираем неполными данными
+            raw_calls = None
+            hourly = None
+        ph["rows"] = calls_count
+    operators_map = OPERATORS or operators_from_calls
+    with run.phase("line") as ph:
+        try:
+            line_seconds = fetch_line_seconds(date_str, operators_map=operators_map)
+        except Exception as e:
+            print(f"SipSpeak line fetch failed for {date_str}: {e}")
+            line_seconds = {}
+        ph["rows"] = len(line_seconds)
+    with run.phase("ck_sheet") as ph:
+        try:
+            ck_counts = ck_counts_from_sheet(date_str, operators_map)
+            ck_status = "ok" if ck_counts is not None else "skipped"
+        except Exception as e:
+            print(f"CK sheet fetch failed for {date_str}: {e}")
+            ck_counts = {}
+            ck_status = "error"
+        ph["rows"] = sum((ck_counts or {}).values())
+    if ck_counts:
+        stats.assign("ck_lead", ck_counts)
+        stats.fill_names(ck_counts, lambda oid: operators_map.get(oid, ""))
+    stats.assign("line", line_seconds)
+    stats.fill_names(line_seconds, lambda oid: operators_map.get(oid, ""))
+
+    amo_status = "disabled"
     if amo_enabled():
+        amo_status = "ok"
         try:
-            amo_metrics = amo_leads_event_metrics(date_str)
-            amo_calls_1m = amo_calls_over_minute(date_str)
-            amo_users = amo_fetch_users()
+            with run.phase("amo_events") as ph:
+                amo_metrics = amo_leads_event_metrics(date_str)
+                ph["rows"] = sum(len(amo_metrics[k]) for k in ("agreement", "meeting", "success"))
+            with run.phase("amo_notes") as ph:
+                amo_calls_1m = amo_calls_over_minute(date_str)
+                ph["rows"] = sum(amo_calls_1m.values())
+            with run.phase("amo_users") as ph:
+                amo_users = amo_fetch_users()
+                ph["rows"] = len(amo_users)
         except Exception as e:
             print(f"AMO sync failed for {date_str}: {e}")
+            amo_status = "error"
             amo_metrics = {"agreement": Counter(), "meeting": Counter(), "success": Counter(), "revenue": defaultdict(int)}
             amo_calls_1m = Counter()
             amo_users = {}
@@ -1863,54 +2713,78 @@ def sync_day(date_str):
             | set(existing_amo_ids)
         )
         amo_ids = {oid for oid in amo_ids if oid not in EXCLUDED_OPERATOR_IDS}
-        for oid in amo_ids:
-            if oid not in stats:
-                stats[oid] = {
-                    "all": 0,
-                    "total": 0,
-                    "cs8": 0,
-                    "cs20": 0,
-                    "cs22": 0,
-                    "lead_agent": 0,
-                    "line": 0,
-                    "ck_lead": 0,
-                    "amo_calls_1m": 0,
-                    "amo_agreements": 0,
-                    "amo_meetings": 0,
-                    "amo_deals": 0,
-                    "amo_revenue": 0,
-                    "talk_sum": 0,
-                    "talk_count": 0,
-                    "name": ""
-                }
-            stats[oid]["amo_calls_1m"] = amo_calls_1m.get(oid, 0)
-            stats[oid]["amo_agreements"] = amo_metrics["agreement"].get(oid, 0)
-            stats[oid]["amo_meetings"] = amo_metrics["meeting"].get(oid, 0)
-            stats[oid]["amo_deals"] = amo_metrics["success"].get(oid, 0)
-            stats[oid]["amo_revenue"] = amo_metrics["revenue"].get(oid, 0)
-            if not stats[oid].get("name"):
-                stats[oid]["name"] = short_name(amo_users.get(oid, operators_map.get(oid, "")))
+        stats.assign("amo_calls_1m", amo_calls_1m, ids=amo_ids)
+        stats.assign("amo_agreements", amo_metrics["agreement"], ids=amo_ids)
+        stats.assign("amo_meetings", amo_metrics["meeting"], ids=amo_ids)
+        stats.assign("amo_deals", amo_metrics["success"], ids=amo_ids)
+        stats.assign("amo_revenue", amo_metrics["revenue"], ids=amo_ids)
+        stats.fill_names(amo_ids, lambda oid: short_name(amo_users.get(oid, operators_map.get(oid, ""))))
         for oid in MOSCOW_SIPSPEAK_AGREEMENTS_IDS:
             if oid in stats:
-                stats[oid]["amo_agreements"] = stats[oid].get("cs8", 0)
-
-    for oid in list(stats.keys()):
-        if oid in EXCLUDED_OPERATOR_IDS:
-            del stats[oid]
-
-    for oid in stats:
-        stats[oid].setdefault("amo_calls_1m", 0)
-        stats[oid].setdefault("amo_agreements", 0)
-        stats[oid].setdefault("amo_meetings", 0)
-        stats[oid].setdefault("amo_deals", 0)
-        stats[oid].setdefault("amo_revenue", 0)
-    upsert_daily_stats(date_str, stats)
+                stats[oid].amo_agreements = stats[oid].cs8
+
+    stats.drop(EXCLUDED_OPERATOR_IDS)
+    with run.phase("db_upsert") as ph:
+        # Синком день считается только при успешной выгрузке звонков, иначе его снова догрузят
+        upsert_daily_stats(
+            date_str, stats, amo_status=amo_status, ck_status=ck_status, raw_calls=raw_calls, hourly=hourly,
+            synced=raw_calls is not None
+        )
+        ph["rows"] = len(stats)
     return {
         "date": date_str,
         "operators": len(stats),
-        "calls": sum(item["all"] for item in stats.values())
+        "calls": stats.total("all"),
+        "fetched": raw_calls is not None
     }
 
+def list_sync_runs(limit=50):
+    conn = db_connection()
+    try:
+        rows = conn.execute(
+            """
+            SELECT id, date, started_at, caller, status, total_ms, requests, operators, calls, phases, error
+            FROM sync_runs
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    runs = []
+    for row in rows:
+        run = dict(row)
+        try:
+            run["phases"] = json.loads(run["phases"] or "[]")
+        except ValueError:
+            run["phases"] = []
+        runs.append(run)
+    return runs
+
+def summarize_sync_phases(runs):
+    by_phase = defaultdict(list)
+    requests_by_phase = defaultdict(int)
+    for run in runs:
+        for phase in run["phases"]:
+            by_phase[phase["name"]].append(phase["ms"])
+            requests_by_phase[phase["name"]] += phase.get("requests", 0)
+    total_ms = sum(sum(values) for values in by_phase.values()) or 1
+    summary = []
+    for name, values in by_phase.items():
+        values = sorted(values)
+        summary.append({
+            "name": name,
+            "runs": len(values),
+            "avg_ms": int(sum(values) / len(values)),
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "max_ms": values[-1],
+            "requests": requests_by_phase[name],
+            "share": round(sum(values) / total_ms * 100, 1)
+        })
+    summary.sort(key=lambda item: item["avg_ms"], reverse=True)
+    return summary
+
 def sync_range(start_str, end_str):
     start = parse_date(start_str)
     end = parse_date(end_str)
@@ -1932,7 +2806,7 @@ def fetch_operators():
     try:
         while True:
             params = [("page", page), ("limit", limit), ("removed", "false")]
-            r = requests.get(USERS_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+            r = sip_get(USERS_LIST_URL, params=params)
             r.raise_for_status()
             items = r.json().get("items", [])
             if not items:
@@ -1959,7 +2833,7 @@ def fetch_active_campaigns():
     try:
         print("Получение списка активных проектов...")
         params = [("active", "true")]
-        r = requests.get(CAMPAIGN_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        r = sip_get(CAMPAIGN_LIST_URL, params=params)
         r.raise_for_status()
         campaigns = r.json().get("items", [])
         active_campaigns = [str(camp.get("id")) for camp in campaigns if camp.get("id")]
@@ -1981,7 +2855,7 @@ def fetch_new_numbers_total_by_active():
     params.append(("limit", 1))
 
     try:
-        r = requests.get(CONTACT_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        r = sip_get(CONTACT_LIST_URL, params=params)
         r.raise_for_status()
         data = r.json()
         return data.get("totalCount", len(data.get("items", [])))
@@ -2009,96 +2883,130 @@ def build_base_params(requested_date=None, operators_map=None):
     return params
 
 
-def fetch_counts(status_list, requested_date=None, operators_map=None):
-    if operators_map is None:
-        operators_map = OPERATORS
-    params = build_base_params(requested_date=requested_date, operators_map=operators_map) + ALL_CALLS_PARAMS
+def fetch_count_total(status_list, oid, requested_date=None):
+    """Число звонков оператора по totalCount без загрузки самих звонков; None, если totalCount нет."""
+    params = build_base_params(requested_date=requested_date, operators_map=[oid]) + COUNT_ONLY_PARAMS
     for s in status_list:
         params.append(("client_statuses[]", s))
-    r = requests.get(CALL_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    r = sip_get(CALL_LIST_URL, params=params)
     r.raise_for_status()
-    cnt = Counter()
-    for it in r.json().get("items", []):
-        oid = str(it.get("operator",{}).get("id") or "")
-        if not operators_map or oid in operators_map:
-            cnt[oid] += 1
-    return cnt
+    return r.json().get("totalCount")
+
 
+def fetch_count_sets(status_sets, requested_date=None, operators_map=None):
+    """Счётчики по операторам для нескольких наборов статусов: name -> Counter.
 
-def fetch_all_counts(requested_date=None, operators_map=None):
-    return fetch_counts([], requested_date=requested_date, operators_map=operators_map)
+    На каждую пару (набор, оператор) уходит параллельный запрос с limit=1,
+    из которого берётся totalCount. Возвращает None, если API не вернул
+    totalCount, — тогда счётчики считаются по выгрузке звонков.
+    """
+    if operators_map is None:
+        operators_map = OPERATORS
+    tasks = [(name, oid) for name in status_sets for oid in operators_map]
+    worker = metrics.propagate(
+        lambda name, oid: fetch_count_total(status_sets[name], oid, requested_date=requested_date)
+    )
+    result = {name: Counter() for name in status_sets}
+    with ThreadPoolExecutor(max_workers=max(1, min(SIP_COUNT_WORKERS, len(tasks)))) as pool:
+        futures = {pool.submit(worker, name, oid): (name, oid) for name, oid in tasks}
+        for future in as_completed(futures):
+            name, oid = futures[future]
+            total = future.result()
+            if total is None:
+                print(f"SipSpeak totalCount missing for {name}, counting call items")
+                for pending in futures:
+                    pending.cancel()
+                return None
+            if total:
+                result[name][oid] = int(total)
+    return result
+
+
+def report_int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
 
+class OperatorStatePoller:
+    """Общий кэш /user_report/list и /user_report/list/history.
+
+    Каждый отчёт запрашивается не чаще раза в interval секунд на пару
+    (дата, набор операторов); /stats и sync_day читают из одного снимка.
+    Параллельные запросы за тем же ключом ждут один общий вызов.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = {}  # (date, operators) -> {"lock", "list", "history", "used"}
+
+    def _entry(self, key):
+        now = time.monotonic()
+        with self.lock:
+            stale = [k for k, e in self.entries.items() if now - e["used"] > self.interval * 10]
+            for k in stale:
+                del self.entries[k]
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"lock": threading.Lock(), "list": None, "history": None, "used": now}
+            entry["used"] = now
+            return entry
+
+    def _report(self, name, date_str, operators_map):
+        entry = self._entry((date_str, frozenset(operators_map)))
+        with entry["lock"]:
+            cached = entry[name]
+            if cached and time.monotonic() - cached[0] < self.interval:
+                return cached[1]
+            params = build_base_params(requested_date=date_str, operators_map=operators_map) + [("page",1),("limit",1000)]
+            r = sip_get(LIST_URL if name == "list" else HIST_URL, params=params)
+            r.raise_for_status()
+            out = {}
+            for item in r.json().get("items", []):
+                oid = str(item.get("id") or "")
+                if operators_map and oid not in operators_map:
+                    continue
+                line = item.get("active"), item.get("dnd"), item.get("call"), item.get("ringing")
+                out[oid] = {"event": item.get("event"), "line": sum(report_int(v) for v in line)}
+            entry[name] = (time.monotonic(), out)
+            return out
+
+    def _resolve(self, requested_date, operators_map):
+        date_str = requested_date or TEST_DATE or datetime.now(pytz.timezone("Europe/Samara")).strftime("%d-%m-%Y")
+        return date_str, OPERATORS if operators_map is None else operators_map
+
+    def state(self, requested_date=None, operators_map=None):
+        """oid -> {"status", "last_event", "line"} по обоим отчётам."""
+        date_str, operators_map = self._resolve(requested_date, operators_map)
+        history = self._report("history", date_str, operators_map)
+        current = self._report("list", date_str, operators_map)
+        out = {}
+        for oid in set(history) | set(current):
+            event = (current.get(oid) or {}).get("event") or (history.get(oid) or {}).get("event")
+            out[oid] = {
+                "status": STATUS_MAP.get(event, event) if event else None,
+                "last_event": event,
+                "line": current[oid]["line"] if oid in current else None,
+            }
+        return out
 
-def fetch_all_calls_details(requested_date=None, operators_map=None):
-    params = build_base_params(requested_date=requested_date, operators_map=operators_map) + ALL_CALLS_PARAMS
-    r = requests.get(CALL_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
-    return r.json().get("items", [])
+    def line_seconds(self, requested_date=None, operators_map=None):
+        date_str, operators_map = self._resolve(requested_date, operators_map)
+        return {oid: item["line"] for oid, item in self._report("list", date_str, operators_map).items()}
 
+OPERATOR_STATE = OperatorStatePoller(LIVE_STATE_TTL)
 
 def fetch_current_status(requested_date=None, operators_map=None):
-    if operators_map is None:
-        operators_map = OPERATORS
-    params = build_base_params(requested_date=requested_date, operators_map=operators_map) + [("page",1),("limit",1000)]
-    r1 = requests.get(HIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT); r1.raise_for_status()
-    r2 = requests.get(LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT); r2.raise_for_status()
-    status = {}
-    for ev in r1.json().get("items", []):
-        oid = str(ev.get("id") or "")
-        if (not operators_map or oid in operators_map) and ev.get("event"):
-            status[oid] = ev["event"]
-    for ev in r2.json().get("items", []):
-        oid = str(ev.get("id") or "")
-        if (not operators_map or oid in operators_map) and ev.get("event"):
-            status[oid] = ev["event"]
-    return {oid: STATUS_MAP.get(st, st) for oid,st in status.items()}
+    state = OPERATOR_STATE.state(requested_date, operators_map)
+    return {oid: item["status"] for oid, item in state.items() if item["status"]}
 
 def fetch_line_times(requested_date=None, operators_map=None):
-    if operators_map is None:
-        operators_map = OPERATORS
-    params = build_base_params(requested_date=requested_date, operators_map=operators_map) + [("page",1),("limit",1000)]
-    r = requests.get(LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
-    out = {}
-    for item in r.json().get("items", []):
-        oid = str(item.get("id") or "")
-        if operators_map and oid not in operators_map:
-            continue
-        def to_int(value):
-            try:
-                return int(value or 0)
-            except (TypeError, ValueError):
-                return 0
-        active = to_int(item.get("active"))
-        dnd = to_int(item.get("dnd"))
-        call = to_int(item.get("call"))
-        ringing = to_int(item.get("ringing"))
-        line_total = active + dnd + call + ringing
-        out[oid] = format_hms(line_total)
-    return out
+    seconds = OPERATOR_STATE.line_seconds(requested_date, operators_map)
+    return {oid: format_hms(value) for oid, value in seconds.items()}
 
 def fetch_line_seconds(date_str, operators_map=None):
-    if operators_map is None:
-        operators_map = OPERATORS
-    params = build_base_params(requested_date=date_str, operators_map=operators_map) + [("page",1),("limit",1000)]
-    r = requests.get(LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
-    r.raise_for_status()
-    out = {}
-    for item in r.json().get("items", []):
-        oid = str(item.get("id") or "")
-        if operators_map and oid not in operators_map:
-            continue
-        def to_int(value):
-            try:
-                return int(value or 0)
-            except (TypeError, ValueError):
-                return 0
-        active = to_int(item.get("active"))
-        dnd = to_int(item.get("dnd"))
-        call = to_int(item.get("call"))
-        ringing = to_int(item.get("ringing"))
-        out[oid] = active + dnd + call + ringing
-    return out
+    return OPERATOR_STATE.line_seconds(date_str, operators_map)
 
 def extract_operators_from_calls(calls):
     operators = {}
@@ -2129,12 +3037,13 @@ def fetch_new_numbers_total_by_noactive():
     params.append(("page", 1))
     params.append(("limit", 1))
 
-    r = requests.get(CONTACT_LIST_URL, params=params, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    r = sip_get(CONTACT_LIST_URL, params=params)
     r.raise_for_status()
     data = r.json()
     return data.get("totalCount", len(data.get("items", [])))
 
 sched = None
+SCHEDULER_LEASE = None
 SYNC_LOCK = threading.Lock()
 SYNC_IN_FLIGHT = set()
 LAST_SYNC_TS = {}
@@ -2152,13 +3061,161 @@ def trigger_background_sync(date_str):
         LAST_SYNC_TS[date_str] = now
     def runner():
         try:
-            sync_day(date_str)
+            with metrics.caller_scope("background_sync"):
+                sync_day(date_str)
         finally:
             with SYNC_LOCK:
                 SYNC_IN_FLIGHT.discard(date_str)
     threading.Thread(target=runner, daemon=True).start()
     return True
 
+def backfill_status(row):
+    return {
+        "id": row["id"],
+        "status": row["status"],
+        "start": row["start"],
+        "end": row["end"],
+        "total": len(json.loads(row["dates"])),
+        "done": row["done"],
+        "failed": json.loads(row["failed"]),
+        "current": row["current"],
+        "created_at": row["created_at"],
+        "finished_at": row["finished_at"],
+    }
+
+def get_backfill_job(job_id):
+    conn = db_connection()
+    try:
+        row = conn.execute("SELECT * FROM backfill_jobs WHERE id = ?", (job_id,)).fetchone()
+        return backfill_status(row) if row else None
+    finally:
+        conn.close()
+
+def start_backfill(start_date, end_date):
+    """Ставит недостающие дни периода в фоновую догрузку.
+
+    Возвращает статус задачи, которая догружает эти дни (новой или уже идущей),
+    либо None, если догружать нечего. Задачи и очередь дней лежат в SQLite,
+    поэтому статус виден любому воркеру, а день не догружают два воркера сразу.
+    """
+    missing = find_missing_dates(start_date, end_date)
+    if not missing:
+        return None
+    now = time.time()
+    conn = db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            """
+            SELECT d.date, d.job_id, d.failed_at, j.status, j.heartbeat
+            FROM backfill_dates d LEFT JOIN backfill_jobs j ON j.id = d.job_id
+            WHERE d.date IN ({placeholders})
+            """.format(placeholders=",".join(["?"] * len(missing))),
+            missing
+        ).fetchall()
+        running = []
+        blocked = set()
+        for row in rows:
+            # Задача упавшего воркера перестаёт обновлять heartbeat, и её дни снова свободны
+            if row["status"] in ("queued", "running") and now - row["heartbeat"] < BACKFILL_STALE_SECONDS:
+                running.append(row["job_id"])
+                blocked.add(row["date"])
+            elif row["failed_at"] and now - row["failed_at"] < BACKFILL_RETRY_SECONDS:
+                blocked.add(row["date"])
+        queued = [ds for ds in missing if ds not in blocked]
+        if not queued:
+            conn.rollback()
+            if not running:
+                return None
+            row = conn.execute("SELECT * FROM backfill_jobs WHERE id = ?", (running[-1],)).fetchone()
+            return backfill_status(row) if row else None
+        job_id = f"{int(now)}-{uuid.uuid4().hex[:8]}"
+        conn.execute(
+            """
+            INSERT INTO backfill_jobs (id, status, start, end, dates, created_at, heartbeat)
+            VALUES (?, 'queued', ?, ?, ?, ?, ?)
+            """,
+            (
+                job_id, start_date, end_date, json.dumps(queued),
+                datetime.now(pytz.timezone("Europe/Samara")).strftime("%Y-%m-%d %H:%M:%S"), now
+            )
+        )
+        conn.executemany(
+            """
+            INSERT INTO backfill_dates (date, job_id, failed_at) VALUES (?, ?, NULL)
+            ON CONFLICT(date) DO UPDATE SET job_id=excluded.job_id, failed_at=NULL
+            """,
+            [(ds, job_id) for ds in queued]
+        )
+        conn.execute(
+            """
+            DELETE FROM backfill_jobs WHERE finished_at IS NOT NULL AND id NOT IN (
+                SELECT id FROM backfill_jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?
+            )
+            """,
+            (BACKFILL_JOBS_KEEP,)
+        )
+        conn.commit()
+        status = backfill_status(conn.execute("SELECT * FROM backfill_jobs WHERE id = ?", (job_id,)).fetchone())
+    finally:
+        conn.close()
+    threading.Thread(target=run_backfill, args=(job_id, queued), name=f"backfill-{job_id}", daemon=True).start()
+    return status
+
+def run_backfill(job_id, dates):
+    failed = []
+    with metrics.caller_scope("backfill"):
+        for ds in dates:
+            conn = db_connection()
+            try:
+                conn.execute(
+                    "UPDATE backfill_jobs SET status = 'running', current = ?, heartbeat = ? WHERE id = ?",
+                    (ds, time.time(), job_id)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            try:
+                # sync_day переживает сбой выгрузки звонков сам, но тогда день остаётся не синкнутым
+                ok = sync_day(ds)["fetched"]
+                if not ok:
+                    print(f"Backfill failed for {ds}: calls were not fetched")
+            except Exception as e:
+                print(f"Backfill failed for {ds}: {e}")
+                ok = False
+            conn = db_connection()
+            try:
+                if ok:
+                    conn.execute("UPDATE backfill_jobs SET done = done + 1, heartbeat = ? WHERE id = ?", (time.time(), job_id))
+                    conn.execute("DELETE FROM backfill_dates WHERE date = ? AND job_id = ?", (ds, job_id))
+                else:
+                    failed.append(ds)
+                    conn.execute(
+                        "UPDATE backfill_jobs SET failed = ?, heartbeat = ? WHERE id = ?",
+                        (json.dumps(failed), time.time(), job_id)
+                    )
+                    conn.execute(
+                        "UPDATE backfill_dates SET job_id = NULL, failed_at = ? WHERE date = ? AND job_id = ?",
+                        (time.time(), ds, job_id)
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+    conn = db_connection()
+    try:
+        conn.execute(
+            """
+            UPDATE backfill_jobs SET status = ?, current = NULL, finished_at = ?, heartbeat = ? WHERE id = ?
+            """,
+            (
+                "failed" if failed and len(failed) == len(dates) else "done",
+                datetime.now(pytz.timezone("Europe/Samara")).strftime("%Y-%m-%d %H:%M:%S"), time.time(), job_id
+            )
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
 def sync_yesterday():
     tz = pytz.timezone("Europe/Samara")
     day = datetime.now(tz).date() - timedelta(days=1)
@@ -2188,23 +3245,86 @@ def sync_existing_dates():
         except Exception as e:
             print(f"Nightly sync failed for {ds}: {e}")
 
-def init_scheduler():
+def build_scheduler():
+    scheduler = BackgroundScheduler(timezone="Europe/Samara")
+    # Обновление списка активных проектов в 10:00
+    scheduler.add_job(leader_job("job:fetch_active_campaigns", fetch_active_campaigns), 'cron', hour=10, minute=0)
+    # Автосинхронизация вчерашнего дня в 00:10
+    scheduler.add_job(leader_job("job:sync_yesterday", sync_yesterday), 'cron', hour=0, minute=10)
+    # Полный синк ЦК из Google Sheets раз в день в 00:30
+    scheduler.add_job(leader_job("job:sync_ck_sheet_all", sync_ck_sheet_all), 'cron', hour=0, minute=30)
+    # Ночной полный пересинк всех дат из БД
+    try:
+        hour, minute = [int(x) for x in NIGHTLY_SYNC_TIME.split(":", 1)]
+    except Exception:
+        hour, minute = 2, 30
+    scheduler.add_job(leader_job("job:sync_existing_dates", sync_existing_dates), 'cron', hour=hour, minute=minute)
+    return scheduler
+
+def leader_job(caller, fn):
+    job = metrics.with_caller(caller, fn)
+    def runner():
+        # Аренду могли потерять между тиками продления — тогда задачу выполнит новый лидер
+        if SCHEDULER_LEASE is not None and not SCHEDULER_LEASE.is_leader:
+            print(f"Skip {caller}: scheduler lease is not held")
+            return
+        return job()
+    runner.__name__ = job.__name__
+    return runner
+
+def start_scheduler():
     global sched
     if sched is None:
-        sched = BackgroundScheduler(timezone="Europe/Samara")
-        # Обновление списка активных проектов в 10:00
-        sched.add_job(fetch_active_campaigns, 'cron', hour=10, minute=0)
-        # Автосинхронизация вчерашнего дня в 00:10
-        sched.add_job(sync_yesterday, 'cron', hour=0, minute=10)
-        # Полный синк ЦК из Google Sheets раз в день в 00:30
-        sched.add_job(sync_ck_sheet_all, 'cron', hour=0, minute=30)
-        # Ночной полный пересинк всех дат из БД
-        try:
-            hour, minute = [int(x) for x in NIGHTLY_SYNC_TIME.split(":", 1)]
-        except Exception:
-            hour, minute = 2, 30
-        sched.add_job(sync_existing_dates, 'cron', hour=hour, minute=minute)
+        sched = build_scheduler()
         sched.start()
+        print("Scheduler started")
+
+def stop_scheduler():
+    global sched
+    if sched is not None:
+        sched.shutdown(wait=False)
+        sched = None
+        print("Scheduler stopped")
+
+def init_scheduler():
+    """Планировщик работает только в процессе, который держит аренду scheduler в SQLite."""
+    global SCHEDULER_LEASE
+    if SCHEDULER_LEASE is None:
+        SCHEDULER_LEASE = LeaderLease(
+            db_connection, "scheduler", SCHEDULER_LEASE_TTL,
+            on_acquire=start_scheduler, on_release=stop_scheduler
+        )
+        SCHEDULER_LEASE.start()
+        atexit.register(SCHEDULER_LEASE.stop)
+
+@app.before_request
+def start_request_tracking():
+    metrics.set_caller(request.endpoint or request.path)
+    g.request_started = time.perf_counter()
+    g.upstream_calls = metrics.start_capture()
+    slowlog.start_queries()
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_tracking(exc=None):
+    metrics.set_caller(None)
+    upstream_calls = g.pop("upstream_calls", None) or []
+    metrics.stop_capture(upstream_calls)
+    queries = slowlog.stop_queries()
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    ms = int((time.perf_counter() - started) * 1000)
+    if ms < SLOW_REQUEST_MS:
+        return
+    params = {k: v for k, v in request.args.items() if k != "token"}
+    status = g.get("response_status", 500 if exc else None)
+    slowlog.add(request.endpoint, request.path, params, status, ms, upstream_calls, queries)
+    print(f"Slow request {request.path} {params}: {ms} ms, upstream={len(upstream_calls)}, queries={sum(queries.values())}")
 
 def render_dashboard():
     today = TEST_DATE or datetime.now(pytz.timezone("Europe/Samara")).strftime("%d.%m.%Y")
@@ -2227,21 +3347,23 @@ def report_data():
     start = request.args.get("start")
     end = request.args.get("end")
     branch = (request.args.get("branch") or "").lower()
-    if start and end:
-        ensure_range_synced(start, end)
+    backfill = start_backfill(start, end) if start and end else None
     if branch == "moscow":
         if not start or not end:
             uly = get_report_data(start, end)
             if uly.get("range"):
                 start = start or uly["range"]["start"]
                 end = end or uly["range"]["end"]
-        return jsonify(get_moscow_report_data_db(start, end))
+        moscow = get_moscow_report_data_db(start, end)
+        moscow["backfill"] = backfill
+        return jsonify(moscow)
 
     data = get_report_data(start, end)
     rows = filter_report_rows(data.get("rows", []), "ulyanovsk")
     data["rows"] = rows
     data["totals"] = recalc_report_totals(rows)
     if branch == "ulyanovsk":
+        data["backfill"] = backfill
         return jsonify(data)
 
     range_start = start
@@ -2253,9 +3375,22 @@ def report_data():
     return jsonify({
         "range": data.get("range") or moscow.get("range"),
         "ulyanovsk": data,
-        "moscow": moscow
+        "moscow": moscow,
+        "backfill": backfill
     })
 
+@app.route('/report/hourly')
+def report_hourly():
+    operator_ids = [oid for oid in request.args.getlist("operator") if oid]
+    return jsonify(get_hourly_report(request.args.get("start"), request.args.get("end"), operator_ids))
+
+@app.route('/report/backfill/<job_id>')
+def report_backfill(job_id):
+    job = get_backfill_job(job_id)
+    if not job:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
 @app.route('/report/export')
 def report_export():
     fmt = (request.args.get("format") or "xlsx").lower()
@@ -2264,8 +3399,7 @@ def report_export():
     start = request.args.get("start")
     end = request.args.get("end")
     branch = (request.args.get("branch") or "").lower()
-    if start and end:
-        ensure_range_synced(start, end)
+    backfill = start_backfill(start, end) if start and end else None
     data = get_report_data(start, end)
     uly_rows = filter_report_rows(data.get("rows", []), "ulyanovsk")
     uly_totals = recalc_report_totals(uly_rows)
@@ -2351,15 +3485,29 @@ def report_export():
 
     if period:
         filename = f"report_{period['start']}_{period['end']}.xlsx"
+    if backfill:
+        # Выгрузка содержит только уже сохранённые дни: предупреждаем первым листом и именем файла
+        pending = backfill["total"] - backfill["done"]
+        ws_note = wb.create_sheet("Неполные данные", 0)
+        ws_note.append([f"Отчёт неполный: {pending} дн. периода ещё догружаются (задача {backfill['id']})."])
+        ws_note.append(["Повторите выгрузку после завершения догрузки."])
+        for sheet in wb.worksheets:
+            sheet.sheet_view.tabSelected = False
+        wb.active = 0
+        filename = filename.replace(".xlsx", "_partial.xlsx")
     output = io.BytesIO()
     wb.save(output)
     output.seek(0)
-    return send_file(
+    response = send_file(
         output,
         as_attachment=True,
         download_name=filename,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
+    if backfill:
+        response.headers["X-Backfill-Job"] = backfill["id"]
+        response.headers["X-Backfill-Pending"] = str(backfill["total"] - backfill["done"])
+    return response
 
 @app.route('/admin')
 def admin_page():
@@ -2385,24 +3533,86 @@ def admin_db():
     start = request.args.get("start")
     end = request.args.get("end")
     available = list_saved_dates()
-    missing = []
-    if start and end:
-        start_date = parse_date(start)
-        end_date = parse_date(end)
-        if start_date > end_date:
-            start_date, end_date = end_date, start_date
-        available_set = set(available)
-        d = start_date
-        while d <= end_date:
-            ds = format_date(d)
-            if ds not in available_set:
-                missing.append(ds)
-            d += timedelta(days=1)
+    missing = find_missing_dates(start, end)
     return jsonify({
         "available": available,
         "missing": missing
     })
 
+@app.route('/admin/metrics')
+def admin_metrics():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/admin/sync-runs')
+def admin_sync_runs():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 50), 500))
+    except ValueError:
+        return jsonify({"error": "limit must be int"}), 400
+    runs = list_sync_runs(limit)
+    return jsonify({
+        "runs": runs,
+        "phases": summarize_sync_phases(runs)
+    })
+
+@app.route('/admin/profile')
+def admin_profile():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(PROFILER.status())
+
+@app.route('/admin/profile/start')
+def admin_profile_start():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        seconds = int(request.args.get("seconds") or 30)
+        interval_ms = int(request.args.get("interval_ms") or 10)
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be int"}), 400
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    interval_ms = max(1, min(interval_ms, 1000))
+    if not PROFILER.start(seconds, PROFILE_DIR, interval=interval_ms / 1000):
+        return jsonify({"error": "profiler already running", "status": PROFILER.status()}), 409
+    return jsonify({"status": "ok", "profile": PROFILER.status()})
+
+@app.route('/admin/profile/download')
+def admin_profile_download():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    status = PROFILER.status()
+    if not status["file"]:
+        return jsonify({"error": "no profile yet"}), 404
+    return send_file(
+        os.path.join(PROFILE_DIR, status["file"]),
+        as_attachment=True,
+        download_name=status["file"],
+        mimetype="text/plain"
+    )
+
+@app.route('/admin/slow')
+def admin_slow():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({"threshold_ms": SLOW_REQUEST_MS, "entries": slowlog.entries()})
+
+@app.route('/admin/scheduler')
+def admin_scheduler():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    if SCHEDULER_LEASE is None:
+        return jsonify({"enabled": False})
+    jobs = []
+    if sched is not None:
+        for job in sched.get_jobs():
+            next_run = job.next_run_time.strftime("%Y-%m-%d %H:%M:%S") if job.next_run_time else None
+            jobs.append({"name": job.name, "next_run": next_run})
+    return jsonify({"enabled": True, **SCHEDULER_LEASE.status(), "jobs": jobs})
+
 @app.route('/admin/nightly')
 def admin_nightly():
     if not require_admin():
@@ -2444,6 +3654,17 @@ def admin_sync():
         print(error_details)
         return jsonify({"error": str(e), "details": error_details}), 500
 
+@app.route('/admin/recompute')
+def admin_recompute():
+    if not require_admin():
+        return jsonify({"error": "unauthorized"}), 401
+    start = request.args.get("start")
+    end = request.args.get("end")
+    if not start or not end:
+        return jsonify({"error": "start/end required"}), 400
+    result = recompute_range(start, end)
+    return jsonify({"status": "ok", "days": len(result["recomputed"]), **result})
+
 @app.route('/admin/ck/sync')
 def admin_ck_sync():
     if not require_admin():
@@ -2463,7 +3684,8 @@ def stats():
     requested_date = request.args.get("date")
     if requested_date:
         today = datetime.now(pytz.timezone("Europe/Samara")).strftime("%d-%m-%Y")
-        if has_date_in_db(requested_date) and has_call_data_for_date(requested_date):
+        state = get_sync_state(requested_date)
+        if state and state["calls"] > 0:
             fetch_operators()
             update_ck_lead_from_sheet(requested_date, OPERATORS)
             cached = get_day_stats_from_db(requested_date)
@@ -2481,27 +3703,34 @@ def stats():
         if cached:
             return jsonify(cached)
     fetch_operators()
-    calls   = fetch_all_calls_details(requested_date=requested_date, operators_map=OPERATORS)
-    operators_from_calls = extract_operators_from_calls(calls)
-    operators_map = OPERATORS or operators_from_calls
-    total_dialogs = defaultdict(int)
-    cs8     = fetch_counts(CS8, requested_date=requested_date, operators_map=operators_map)
-    cs20    = fetch_counts(CS20, requested_date=requested_date, operators_map=operators_map)
-    lead_agent = fetch_counts(LEAD_AGENT, requested_date=requested_date, operators_map=operators_map)
-    allc    = fetch_all_counts(requested_date=requested_date, operators_map=operators_map)
+    counts = None
+    if OPERATORS:
+        counts = fetch_count_sets(
+            {"all": [], "cs8": CS8, "cs20": CS20, "lead_agent": LEAD_AGENT},
+            requested_date=requested_date, operators_map=OPERATORS
+        )
+    if counts is not None:
+        # Счётчики пришли через totalCount; диалоги и средняя длительность считаются
+        # по самим звонкам, но только со статусами STAT_FULL
+        stats, _, _ = aggregate_call_pages(
+            iter_call_pages(requested_date, operators_map=OPERATORS, statuses=STAT_FULL), operators_map=OPERATORS
+        )
+        operators_map = OPERATORS
+    else:
+        # Без списка операторов (или без totalCount) всё считается по одной выгрузке звонков дня
+        stats, operators_from_calls, _ = aggregate_call_pages(
+            iter_call_pages(requested_date, operators_map=OPERATORS), operators_map=OPERATORS
+        )
+        operators_map = OPERATORS or operators_from_calls
+        counts = {
+            name: {oid: getattr(rec, name) for oid, rec in stats.items()}
+            for name in ("all", "cs8", "cs20", "lead_agent")
+        }
+    allc, cs8, cs20, lead_agent = counts["all"], counts["cs8"], counts["cs20"], counts["lead_agent"]
+    total_dialogs = {oid: rec.total for oid, rec in stats.items()}
+    avg     = {oid: (rec.talk_sum // rec.talk_count if rec.talk_count else 0) for oid, rec in stats.items()}
     new_tot = fetch_new_numbers_total_by_active()
     new_noactive_tot = fetch_new_numbers_total_by_noactive()
-    sums, cnts = defaultdict(int), defaultdict(int)
-    for c in calls:
-        oid = str(c.get("operator",{}).get("id") or "")
-        if not operators_map or oid in operators_map:
-            status = get_status_id(c)
-            td = get_talk_duration(c)
-            if status in STAT_FULL and td > 20:
-                total_dialogs[oid] += 1
-                sums[oid] += td
-                cnts[oid] += 1
-    avg    = {oid:(sums[oid]//cnts[oid] if cnts[oid] else 0) for oid in operators_map}
     status = fetch_current_status(requested_date=requested_date, operators_map=operators_map)
     line_times = fetch_line_times(requested_date=requested_date, operators_map=operators_map)
 
@@ -2527,6 +3756,12 @@ def stats():
     date_for_amo = requested_date or datetime.now(pytz.timezone(AMO_TZ)).strftime("%d-%m-%Y")
     return jsonify(merge_amo_counts(payload, date_for_amo))
 
+# Под WSGI модуль импортирует каждый воркер: планировщик запускается везде,
+# а задачи выполняет только тот воркер, что держит аренду
+if SCHEDULER_AUTOSTART:
+    init_db()
+    init_scheduler()
+
 if __name__ == '__main__':
     init_db()
     init_scheduler()
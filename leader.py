@@ -0,0 +1,119 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class LeaderLease:
+    """Выбор лидера между процессами через аренду в SQLite.
+
+    Каждый процесс раз в ttl/3 пытается взять или продлить строку аренды.
+    Владелец держит её, пока продлевает; если он упал, через ttl аренду
+    забирает другой процесс. on_acquire/on_release вызываются из фонового
+    потока при смене роли.
+    """
+
+    def __init__(self, connect, name, ttl=60, on_acquire=None, on_release=None):
+        self.connect = connect
+        self.name = name
+        self.ttl = ttl
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self.expires_at = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name=f"lease-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        self.release()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.tick()
+            self.stop_event.wait(max(1, self.ttl / 3))
+
+    def tick(self):
+        try:
+            held = self.try_acquire()
+        except sqlite3.Error as e:
+            print(f"Lease {self.name}: renew failed: {e}")
+            # Без подтверждения считаем себя лидером только до конца уже взятой аренды
+            held = self.is_leader and time.time() < self.expires_at
+        if held and not self.is_leader:
+            self.is_leader = True
+            print(f"Lease {self.name}: acquired by {self.owner}")
+            if self.on_acquire:
+                self.on_acquire()
+        elif not held and self.is_leader:
+            self.is_leader = False
+            print(f"Lease {self.name}: lost by {self.owner}")
+            if self.on_release:
+                self.on_release()
+        return held
+
+    def try_acquire(self):
+        now = time.time()
+        expires_at = now + self.ttl
+        conn = self.connect()
+        try:
+            cur = conn.execute(
+                """
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                """,
+                (self.name, self.owner, expires_at, now)
+            )
+            conn.commit()
+            if cur.rowcount:
+                self.expires_at = expires_at
+                return True
+            return False
+        finally:
+            conn.close()
+
+    def release(self):
+        was_leader = self.is_leader
+        self.is_leader = False
+        try:
+            conn = self.connect()
+            try:
+                conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Lease {self.name}: release failed: {e}")
+        if was_leader and self.on_release:
+            self.on_release()
+
+    def status(self):
+        row = None
+        try:
+            conn = self.connect()
+            try:
+                row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "leader": self.is_leader,
+            "holder": row[0] if row else None,
+            "expires_in": round(row[1] - time.time(), 1) if row else None,
+            "ttl": self.ttl,
+        }
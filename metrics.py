@@ -0,0 +1,180 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_ID_RE = re.compile(r"/\d+(?=/|$)")
+
+_lock = threading.Lock()
+_requests = defaultdict(int)     # (upstream, endpoint, caller, status) -> count
+_bytes = defaultdict(int)        # (upstream, endpoint, caller) -> bytes
+_retries = defaultdict(int)      # (upstream, endpoint, caller) -> retries
+_latency = {}                    # (upstream, endpoint, caller) -> [bucket counts..., sum, count]
+_local = threading.local()
+
+
+def normalize_endpoint(path):
+    path = (path or "").split("?", 1)[0]
+    return _ID_RE.sub("/{id}", path)
+
+
+def get_caller():
+    # Имя потока (ThreadPoolExecutor-3_7 и т.п.) раздувало бы кардинальность метки caller
+    return getattr(_local, "caller", None) or "background"
+
+
+def set_caller(caller):
+    _local.caller = caller
+
+
+@contextmanager
+def caller_scope(caller):
+    previous = getattr(_local, "caller", None)
+    _local.caller = caller
+    try:
+        yield
+    finally:
+        _local.caller = previous
+
+
+def with_caller(caller, fn):
+    def runner(*args, **kwargs):
+        with caller_scope(caller):
+            return fn(*args, **kwargs)
+    runner.__name__ = getattr(fn, "__name__", "job")
+    return runner
+
+
+def propagate(fn):
+    """Переносит caller и активные capture() текущего потока в fn, запускаемую в другом потоке."""
+    caller = getattr(_local, "caller", None)
+    captures = list(getattr(_local, "captures", None) or ())
+
+    def runner(*args, **kwargs):
+        previous = getattr(_local, "caller", None), getattr(_local, "captures", None)
+        _local.caller = caller
+        _local.captures = list(captures)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.caller, _local.captures = previous
+    return runner
+
+
+def start_capture():
+    calls = []
+    stack = getattr(_local, "captures", None)
+    if stack is None:
+        stack = _local.captures = []
+    stack.append(calls)
+    return calls
+
+
+def stop_capture(calls):
+    stack = getattr(_local, "captures", None) or []
+    # Сравниваем по identity: вложенный capture равен внешнему по содержимому
+    for i, item in enumerate(stack):
+        if item is calls:
+            del stack[i]
+            break
+
+
+@contextmanager
+def capture():
+    """Собирает вызовы апстримов текущего потока внутри блока with."""
+    calls = start_capture()
+    try:
+        yield calls
+    finally:
+        stop_capture(calls)
+
+
+def record(upstream, endpoint, status, seconds, nbytes=0):
+    endpoint = normalize_endpoint(endpoint)
+    caller = get_caller()
+    key = (upstream, endpoint, caller)
+    for calls in getattr(_local, "captures", None) or ():
+        calls.append({"upstream": upstream, "endpoint": endpoint, "status": str(status),
+                      "ms": int(seconds * 1000), "bytes": nbytes})
+    with _lock:
+        _requests[key + (str(status),)] += 1
+        _bytes[key] += nbytes
+        hist = _latency.get(key)
+        if hist is None:
+            hist = _latency[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+
+def record_retry(upstream, endpoint):
+    key = (upstream, normalize_endpoint(endpoint), get_caller())
+    with _lock:
+        _retries[key] += 1
+
+
+def observe(upstream, endpoint, send):
+    started = time.perf_counter()
+    try:
+        resp = send()
+    except Exception:
+        record(upstream, endpoint, "error", time.perf_counter() - started)
+        raise
+    record(upstream, endpoint, resp.status_code, time.perf_counter() - started, len(resp.content or b""))
+    return resp
+
+
+def _labels(**labels):
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus():
+    with _lock:
+        requests_snapshot = dict(_requests)
+        bytes_snapshot = dict(_bytes)
+        retries_snapshot = dict(_retries)
+        latency_snapshot = {k: list(v) for k, v in _latency.items()}
+
+    lines = [
+        "# HELP upstream_requests_total Upstream HTTP requests by endpoint, caller and status.",
+        "# TYPE upstream_requests_total counter",
+    ]
+    for (upstream, endpoint, caller, status), value in sorted(requests_snapshot.items()):
+        lines.append(f"upstream_requests_total{_labels(upstream=upstream, endpoint=endpoint, caller=caller, status=status)} {value}")
+
+    lines += [
+        "# HELP upstream_request_duration_seconds Upstream request latency.",
+        "# TYPE upstream_request_duration_seconds histogram",
+    ]
+    for (upstream, endpoint, caller), hist in sorted(latency_snapshot.items()):
+        for bound, value in zip(LATENCY_BUCKETS, hist):
+            labels = _labels(upstream=upstream, endpoint=endpoint, caller=caller, le=bound)
+            lines.append(f"upstream_request_duration_seconds_bucket{labels} {value}")
+        labels = _labels(upstream=upstream, endpoint=endpoint, caller=caller, le="+Inf")
+        lines.append(f"upstream_request_duration_seconds_bucket{labels} {hist[-1]}")
+        labels = _labels(upstream=upstream, endpoint=endpoint, caller=caller)
+        lines.append(f"upstream_request_duration_seconds_sum{labels} {hist[-2]:.6f}")
+        lines.append(f"upstream_request_duration_seconds_count{labels} {hist[-1]}")
+
+    lines += [
+        "# HELP upstream_response_bytes_total Upstream response body bytes.",
+        "# TYPE upstream_response_bytes_total counter",
+    ]
+    for (upstream, endpoint, caller), value in sorted(bytes_snapshot.items()):
+        lines.append(f"upstream_response_bytes_total{_labels(upstream=upstream, endpoint=endpoint, caller=caller)} {value}")
+
+    lines += [
+        "# HELP upstream_retries_total Upstream retries after rate limiting or transport errors.",
+        "# TYPE upstream_retries_total counter",
+    ]
+    for (upstream, endpoint, caller), value in sorted(retries_snapshot.items()):
+        lines.append(f"upstream_retries_total{_labels(upstream=upstream, endpoint=endpoint, caller=caller)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,101 @@
+COUNT_FIELDS = (
+    "all",
+    "total",
+    "cs8",
+    "cs20",
+    "cs22",
+    "lead_agent",
+    "line",
+    "ck_lead",
+    "amo_calls_1m",
+    "amo_agreements",
+    "amo_meetings",
+    "amo_deals",
+    "amo_revenue",
+    "talk_sum",
+    "talk_count",
+)
+
+# Порядок колонок daily_operator_stats, в котором пишет upsert_daily_stats
+DB_COLUMNS = (
+    ("all", "all_calls"),
+    ("total", "total_calls"),
+    ("cs8", "cs8_calls"),
+    ("cs20", "cs20_calls"),
+    ("cs22", "cs22_calls"),
+    ("lead_agent", "lead_agent_calls"),
+    ("line", "line_calls"),
+    ("ck_lead", "ck_lead_calls"),
+    ("amo_calls_1m", "amo_calls_1m"),
+    ("amo_agreements", "amo_agreements"),
+    ("amo_meetings", "amo_meetings"),
+    ("amo_deals", "amo_deals"),
+    ("amo_revenue", "amo_revenue"),
+    ("talk_sum", "talk_sum"),
+    ("talk_count", "talk_count"),
+)
+
+
+class OperatorStats:
+    """Счётчики одного оператора за день (вместо dict на 16 ключей)."""
+
+    __slots__ = COUNT_FIELDS + ("name",)
+
+    def __init__(self, name=""):
+        self.all = 0
+        self.total = 0
+        self.cs8 = 0
+        self.cs20 = 0
+        self.cs22 = 0
+        self.lead_agent = 0
+        self.line = 0
+        self.ck_lead = 0
+        self.amo_calls_1m = 0
+        self.amo_agreements = 0
+        self.amo_meetings = 0
+        self.amo_deals = 0
+        self.amo_revenue = 0
+        self.talk_sum = 0
+        self.talk_count = 0
+        self.name = name
+
+    def db_values(self):
+        return tuple(getattr(self, field) for field, _ in DB_COLUMNS)
+
+
+class StatsTable(dict):
+    """operator_id -> OperatorStats; отсутствующий оператор создаётся с нулями."""
+
+    def __missing__(self, oid):
+        rec = self[oid] = OperatorStats()
+        return rec
+
+    def assign(self, field, values, ids=None):
+        """Проставляет поле из словаря oid -> значение.
+
+        Без ids обновляются только операторы из values; с ids — все из ids,
+        недостающие значения считаются нулём.
+        """
+        if ids is None:
+            for oid, value in values.items():
+                setattr(self[oid], field, value)
+        else:
+            for oid in ids:
+                setattr(self[oid], field, values.get(oid, 0))
+
+    def fill_names(self, ids, lookup):
+        for oid in ids:
+            rec = self[oid]
+            if not rec.name:
+                rec.name = lookup(oid)
+
+    def drop(self, ids):
+        for oid in ids:
+            self.pop(oid, None)
+
+    def total(self, field):
+        return sum(getattr(rec, field) for rec in self.values())
+
+    def db_rows(self, date_str, updated_at):
+        for oid, rec in self.items():
+            yield (date_str, oid, rec.name or oid) + rec.db_values() + (updated_at,)
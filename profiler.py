@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+_THREAD_NUM_RE = re.compile(r"\d+")
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер: раз в interval снимает стеки всех потоков процесса.
+
+    Результат пишется в collapsed-формате (`thread;frame;frame count`),
+    который понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.seconds = 0
+        self.interval = 0.01
+        self.output_path = None
+        self.last_output = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, output_dir, interval=0.01):
+        with self.lock:
+            if self.is_running():
+                return False
+            os.makedirs(output_dir, exist_ok=True)
+            self.stacks = Counter()
+            self.samples = 0
+            self.seconds = seconds
+            self.interval = interval
+            self.started_at = time.time()
+            name = datetime.now().strftime("profile_%Y%m%d_%H%M%S.collapsed")
+            self.output_path = os.path.join(output_dir, name)
+            self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.stacks[self._collapse(names.get(thread_id, "thread"), frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self._write()
+
+    def _collapse(self, thread_name, frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        parts.append(_THREAD_NUM_RE.sub("N", thread_name))
+        parts.reverse()
+        return ";".join(part.replace(";", ",") for part in parts)
+
+    def _write(self):
+        tmp_path = f"{self.output_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, self.output_path)
+        self.last_output = self.output_path
+
+    def status(self):
+        elapsed = min(time.time() - self.started_at, self.seconds) if self.started_at else 0
+        return {
+            "running": self.is_running(),
+            "seconds": self.seconds,
+            "elapsed": round(elapsed, 1),
+            "interval_ms": int(self.interval * 1000),
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "file": os.path.basename(self.last_output) if self.last_output else None,
+        }
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,67 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: выдаёт слоты равномерно в порядке очереди."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Баланс может уйти в минус: каждый вызывающий получает свой слот,
+            # поэтому параллельные потоки не устраивают гонку за токены.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            # Во время блокировки updated стоит на blocked_until: слоты
+            # отсчитываются от конца паузы, а не выдаются все разом
+            return max(self.updated - now, 0.0) + wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            # Пока действует Retry-After, токены не копятся
+            self.updated = max(self.updated, self.blocked_until)
+
+
+def retry_after_seconds(resp, default: float = 1.0) -> float:
+    value = (resp.headers.get("Retry-After") or "").strip() if resp is not None else ""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, dt.timestamp() - time.time())
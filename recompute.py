@@ -0,0 +1,24 @@
+import argparse
+
+import counter
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rebuild call metrics in daily_operator_stats from the stored raw calls, without SipSpeak requests"
+    )
+    parser.add_argument("start", help="First date, dd-mm-YYYY")
+    parser.add_argument("end", nargs="?", help="Last date, dd-mm-YYYY (default: same as start)")
+    args = parser.parse_args()
+
+    counter.init_db()
+    result = counter.recompute_range(args.start, args.end or args.start)
+    for date_str, calls in result["recomputed"].items():
+        print(f"{date_str}: {calls} calls")
+    if result["no_raw_calls"]:
+        print(f"No raw calls (resync to fill): {', '.join(result['no_raw_calls'])}")
+    print(f"Recomputed {len(result['recomputed'])} days")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import Counter, deque
+
+MAX_UPSTREAM_CALLS = 200
+MAX_SQL_LENGTH = 300
+
+_lock = threading.Lock()
+_entries = deque(maxlen=200)
+_local = threading.local()
+
+
+def configure(size):
+    global _entries
+    with _lock:
+        _entries = deque(_entries, maxlen=size)
+
+
+def start_queries():
+    _local.queries = Counter()
+    return _local.queries
+
+
+def stop_queries():
+    queries = getattr(_local, "queries", None)
+    _local.queries = None
+    return queries or Counter()
+
+
+def record_query(sql):
+    queries = getattr(_local, "queries", None)
+    if queries is None:
+        return
+    queries[" ".join(sql.split())[:MAX_SQL_LENGTH]] += 1
+
+
+def add(route, path, params, status, ms, upstream_calls, queries):
+    by_endpoint = {}
+    for call in upstream_calls:
+        key = f"{call['upstream']} {call['endpoint']}"
+        item = by_endpoint.setdefault(key, {"endpoint": key, "count": 0, "ms": 0, "bytes": 0})
+        item["count"] += 1
+        item["ms"] += call["ms"]
+        item["bytes"] += call["bytes"]
+    entry = {
+        "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "route": route,
+        "path": path,
+        "params": params,
+        "status": status,
+        "ms": ms,
+        "upstream_count": len(upstream_calls),
+        "upstream_ms": sum(call["ms"] for call in upstream_calls),
+        "upstream": sorted(by_endpoint.values(), key=lambda item: item["ms"], reverse=True),
+        "upstream_calls": upstream_calls[:MAX_UPSTREAM_CALLS],
+        "query_count": sum(queries.values()),
+        "queries": [{"sql": sql, "count": count} for sql, count in queries.most_common(50)],
+    }
+    with _lock:
+        _entries.append(entry)
+
+
+def entries():
+    with _lock:
+        return list(reversed(_entries))